@@ -4,7 +4,8 @@ import json
 import csv
 import random
 from typing import List, Dict, Union
-from My_traceroute_fixed import Traceroute  # 假设您的traceroute类在traceroute.py中
+from My_traceroute_fixed import Traceroute, YarrpTraceroute, StopSet, TraceOptions, TraceSession  # 假设您的traceroute类在traceroute.py中
+from dataclasses import replace
 from concurrent.futures import ThreadPoolExecutor, as_completed
 from typing import Dict
 
@@ -17,6 +18,8 @@ class TracerouteHandler:
         """
         self.output_dir = output_dir
         os.makedirs(self.output_dir, exist_ok=True)
+        # 各前缀的协议应答率，与结果目录放在一起，跨批次保留
+        self.protocol_table = os.path.join(os.path.dirname(os.path.abspath(output_dir)), "protocol_preferences.json")
 
     def read_targets(self, input_file: str) -> List[str]:
         """
@@ -50,23 +53,22 @@ class TracerouteHandler:
 
         return targets
 
-    def process_target(self, target: str, options: Dict) -> Dict:
+    def process_target(self, target: str, options: Union[Dict, TraceOptions], stop_set: StopSet = None,
+                       session: TraceSession = None) -> Dict:
         """
         处理单个目标
         :param target: 目标地址
-        :param options: traceroute选项字典
+        :param options: traceroute选项（字典或已校验的TraceOptions）
+        :param stop_set: 批次共享的Doubletree停止集合（可选）
+        :param session: 批次共享的套接字会话（可选）
         :return: 追踪结果
         """
-        tracer = Traceroute()
-
-        # 设置选项
-        for opt, value in options.items():
-            if hasattr(tracer.options, opt):
-                setattr(tracer.options, opt, value)
+        if isinstance(options, dict):
+            options = TraceOptions.from_dict(options).validate()
 
-        # 设置目标
-        tracer.options.host = target
-        tracer.options.input_file = None  # 确保使用单个目标模式
+        # 单个目标模式，不再经过命令行解析
+        tracer = Traceroute(options.with_target(target), session=session)
+        tracer.stop_set = stop_set
 
         # 执行追踪
         return tracer.run()
@@ -179,13 +181,22 @@ class TracerouteHandler:
 
             max_workers = 100
 
-            with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            # 选项只校验一次，整个批次共享；未指定时使用结果目录旁的协议偏好表
+            trace_options = TraceOptions.from_dict({"protocol_table": self.protocol_table, **options}).validate()
+
+            # Doubletree：同一批次的所有追踪共享一个停止集合，已知的跳不再重复探测
+            stop_set = StopSet() if trace_options.doubletree_start else None
+
+            # 套接字、源地址选择和接收线程在整个批次内只建立一次
+            with TraceSession(trace_options) as session, ThreadPoolExecutor(max_workers=max_workers) as executor:
                 future_to_target = {
                     executor.submit(
                         self._process_single_target,
                         target,
-                        options,
-                        output_format
+                        trace_options,
+                        output_format,
+                        stop_set,
+                        session
                     ): target
                     for i, target in enumerate(targets)
                 }
@@ -201,9 +212,29 @@ class TracerouteHandler:
             raise
         return all_results
 
-    def _process_single_target(self, target: str, options: Dict, output_format: str) -> tuple:
+    def stateless_trace(self, input_file: str, options: Dict, output_format: str = "json") -> Dict[str, Dict]:
+        """
+        无状态随机顺序探测（yarrp风格），适合大规模目标列表
+        :param input_file: 目标文件路径（每行一个目标）
+        :param options: traceroute选项字典
+        :param output_format: 输出格式(json/text)
+        :return: 每个目标的追踪结果
+        """
+        trace_options = TraceOptions.from_dict(options).validate()
+        tracer = YarrpTraceroute(replace(trace_options, host=None, input_file=input_file))
+
+        all_results = tracer.run()
+        for target, results in all_results.items():
+            try:
+                self.save_results(target, results, output_format)
+            except IOError as e:
+                print(str(e))
+        return all_results
+
+    def _process_single_target(self, target: str, options: TraceOptions, output_format: str,
+                               stop_set: StopSet = None, session: TraceSession = None) -> tuple:
         try:
-            results = self.process_target(target, options)
+            results = self.process_target(target, options, stop_set, session)
             self.save_results(target, results, output_format)
             print(f"Completed tracing to {target}")
             return (target, results)
@@ -224,6 +255,7 @@ if __name__ == "__main__":
         "probe_sequence":["udp", "tcp", "icmp"],
         "max_hops": 30,  # 最大跳数
         "wait": 2000,  # 等待时间(ms)
+        "adaptive_wait": True,  # 按已观测的RTT自适应超时，wait作为上限
         "no_resolve": True,  # 解析主机名
         "extensions": False  # 记录扩展信息
     }
@@ -1,28 +1,1125 @@
 import argparse
+import asyncio
+import ctypes
 import socket
 import threading
 import time
 import struct
 import select
+import errno
+import heapq
+import functools
+import json
+import os
+import statistics
+from collections import deque
+from dataclasses import dataclass, field, fields, replace
 import sys
-from concurrent.futures import ThreadPoolExecutor
 from threading import Lock
-from typing import Optional, List
+from typing import Optional, List, NamedTuple, Callable, Union
 import random
 import platform
+import weakref
+
+
+# Precompiled field accessors for patching probe templates in place
+_U16 = struct.Struct("!H")
+_U32 = struct.Struct("!I")
+_U16_PAIR = struct.Struct("!HH")
+_TCP_PORTS_SEQ = struct.Struct("!HHI")
+_TIMESPEC = struct.Struct("@ll")
+
+# SO_TIMESTAMPNS is missing from the socket module on most Python builds; 35 is its Linux value
+SO_TIMESTAMPNS = getattr(socket, 'SO_TIMESTAMPNS', 35)
+# Receive ring: 1500 bytes covers an MTU-sized ICMP error with extensions
+REPLY_BUFFER_SIZE = 1500
+REPLY_RING_SLOTS = 64
+_ANCBUF_SIZE = socket.CMSG_SPACE(_TIMESPEC.size) + socket.CMSG_SPACE(4) if hasattr(socket, 'CMSG_SPACE') else 0
+_ERRQUEUE_ANCBUF_SIZE = 512
+_QUEUED_ERRNOS = (errno.EHOSTUNREACH, errno.ENETUNREACH, errno.ECONNREFUSED, errno.EPROTO, errno.EACCES)
+
+# Classic BPF (linux/filter.h) for the receive socket filter
+SO_ATTACH_FILTER = 26
+SO_DETACH_FILTER = 27
+BPF_MAXINSNS = 4096
+BPF_ACCEPT = 0xFFFF
+BPF_LDX_MSH = 0xB1  # X = 4 * (pkt[k] & 0xf)
+BPF_LDB_IND = 0x50  # A = pkt[X + k]
+BPF_LDH_IND = 0x48
+BPF_LD_MEM = 0x60   # A = M[k]
+BPF_ST = 0x02       # M[k] = A
+BPF_AND = 0x54
+BPF_LSH = 0x64
+BPF_ADD_X = 0x0C
+BPF_TAX = 0x07
+BPF_JA = 0x05
+BPF_JEQ = 0x15
+BPF_RET = 0x06
+_BPF_INSN = struct.Struct("@HBBI")
+_BPF_PROG = struct.Struct("@HP")
+
+# Per-socket ICMP error queue (linux/errqueue.h) for unprivileged probing
+IP_RECVERR = getattr(socket, 'IP_RECVERR', 11)
+IPV6_RECVERR = getattr(socket, 'IPV6_RECVERR', 25)
+SO_EE_ORIGIN_ICMP = 2
+SO_EE_ORIGIN_ICMP6 = 3
+_SOCK_EXTENDED_ERR = struct.Struct("=IBBBBII")
+
+# Preflight probe: sent with a TTL that reaches any target; the inferred distance bounds
+# the trace, plus some hops because the reply may come back over a different path
+PREFLIGHT_TTL = 255
+DISTANCE_SLACK = 3
+
+# Two-sided 95% normal quantile for --rtt-confidence
+RTT_CONFIDENCE_Z = 1.96
+
+# Send pacing: sleep on absolute CLOCK_MONOTONIC deadlines (the clock behind time.monotonic
+# on Linux), then spin for the last stretch that the kernel's timer slack would blur.
+# A sender that fell behind catches up back to back, by at most PACER_MAX_LAG
+CLOCK_MONOTONIC = 1
+TIMER_ABSTIME = 1
+PACER_SPIN = 0.0002
+PACER_MAX_LAG = 0.01
+# Batched sends through sendmmsg(2) (Linux). Probes already due when a batch goes out share
+# its call, at most SEND_BATCH_MAX of them; none is sent ahead of its pacing deadline
+SEND_BATCH_MAX = 256
+# struct mmsghdr (a struct msghdr plus msg_len) and struct iovec in native layout; the
+# zero-length P fields pad each struct out to pointer alignment as the C compiler does
+_MMSGHDR = struct.Struct("@PIPNPNi0PI0P")
+_IOVEC = struct.Struct("@PN")
+_SA_FAMILY = struct.Struct("=H")
+_CMSG_HDR = struct.Struct("@Nii")
+_CMSG_INT = struct.Struct("@i")
+
+
+# libc entry points called through ctypes
+try:
+    _libc = ctypes.CDLL(None, use_errno=True)
+except OSError:
+    _libc = None
+_clock_nanosleep = getattr(_libc, 'clock_nanosleep', None)
+if _clock_nanosleep is not None:
+    _clock_nanosleep.argtypes = [ctypes.c_int, ctypes.c_int, ctypes.c_void_p, ctypes.c_void_p]
+_libc_sendmmsg = getattr(_libc, 'sendmmsg', None) if platform.system() == 'Linux' else None
+if _libc_sendmmsg is not None:
+    _libc_sendmmsg.argtypes = [ctypes.c_int, ctypes.c_size_t, ctypes.c_uint, ctypes.c_int]
+
+
+def _address_prefix(ip: str) -> bytes:
+    """Destination prefix used for aggregation: /24 for IPv4, /48 for IPv6"""
+    packed = socket.inet_pton(socket.AF_INET6 if ':' in ip else socket.AF_INET, ip)
+    return packed[:3] if len(packed) == 4 else packed[:6]
+
+
+_yield_gil = getattr(os, 'sched_yield', None) or (lambda: time.sleep(0))
+
+
+def _sleep_until(deadline: float):
+    """Block until time.monotonic() reaches deadline; returns at once when already past it"""
+    coarse = deadline - PACER_SPIN
+    if coarse > time.monotonic():
+        if _clock_nanosleep is not None and platform.system() == 'Linux':
+            sec = int(coarse)
+            timespec = _TIMESPEC.pack(sec, int((coarse - sec) * 1e9))
+            # An absolute deadline does not drift when a signal cuts the sleep short
+            while _clock_nanosleep(CLOCK_MONOTONIC, TIMER_ABSTIME, timespec, None) == errno.EINTR:
+                pass
+        else:
+            time.sleep(max(coarse - time.monotonic(), 0))
+    # The final stretch spins, but gives up the GIL on every pass so other traces' threads
+    # and the reply receiver keep running; sched_yield costs well under a microsecond
+    while time.monotonic() < deadline:
+        _yield_gil()
+
+
+@functools.lru_cache(maxsize=4096)
+def _sockaddr(address: tuple) -> bytes:
+    """struct sockaddr_in / sockaddr_in6 for a numeric (host, port)"""
+    if ':' in address[0]:
+        return (_SA_FAMILY.pack(socket.AF_INET6) + _U16.pack(address[1]) + _U32.pack(0)
+                + socket.inet_pton(socket.AF_INET6, address[0]) + _U32.pack(0))
+    return _SA_FAMILY.pack(socket.AF_INET) + _U16.pack(address[1]) + socket.inet_aton(address[0]) + bytes(8)
+
+
+@functools.lru_cache(maxsize=512)
+def _hop_limit_cmsg(v6: bool, ttl: int) -> bytes:
+    """IP_TTL / IPV6_HOPLIMIT control message, padded to CMSG_SPACE"""
+    level, cmsg_type = (socket.IPPROTO_IPV6, socket.IPV6_HOPLIMIT) if v6 else (socket.SOL_IP, socket.IP_TTL)
+    cmsg = _CMSG_HDR.pack(socket.CMSG_LEN(_CMSG_INT.size), level, cmsg_type) + _CMSG_INT.pack(ttl)
+    return cmsg + bytes(socket.CMSG_SPACE(_CMSG_INT.size) - len(cmsg))
+
+
+def _sendmmsg(sock: socket.socket, messages: list) -> int:
+    """
+    Send (packet, address, ttl) messages on sock with one sendmmsg(2) call and return how
+    many the kernel took, which may be fewer than given. A ttl other than None travels as
+    an IP_TTL / IPV6_HOPLIMIT control message of that message alone. Raises OSError if
+    the first message fails.
+    """
+    count = len(messages)
+    if not count:
+        return 0
+    v6 = sock.family == socket.AF_INET6
+
+    # One buffer holds the mmsghdr and iovec arrays, then control message, name and
+    # payload of every message; pointers are filled in once its address is known
+    iov_at = _MMSGHDR.size * count
+    size = iov_at + _IOVEC.size * count
+    parts = []
+    for packet, address, ttl in messages:
+        size += -size % 8  # control messages need pointer alignment
+        control = _hop_limit_cmsg(v6, ttl) if ttl is not None else b''
+        name = _sockaddr(address)
+        parts.append((size, control, name, packet))
+        size += len(control) + len(name) + len(packet)
+
+    blob = bytearray(size)
+    buffer = (ctypes.c_char * size).from_buffer(blob)
+    base = ctypes.addressof(buffer)
+    for i, (at, control, name, packet) in enumerate(parts):
+        name_at = at + len(control)
+        packet_at = name_at + len(name)
+        blob[at:packet_at + len(packet)] = control + name + packet
+        iov = iov_at + i * _IOVEC.size
+        _IOVEC.pack_into(blob, iov, base + packet_at, len(packet))
+        _MMSGHDR.pack_into(blob, i * _MMSGHDR.size, base + name_at, len(name), base + iov, 1,
+                           base + at if control else 0, len(control), 0, 0)
+
+    sent = _libc_sendmmsg(sock.fileno(), base, count, 0)
+    if sent < 0:
+        err = ctypes.get_errno()
+        raise OSError(err, os.strerror(err))
+    return sent
+
+
+def _prefix_label(ip: str) -> str:
+    """Printable form of _address_prefix, e.g. '192.0.2.0/24'"""
+    prefix = _address_prefix(ip)
+    if len(prefix) == 3:
+        return f"{socket.inet_ntoa(prefix + bytes(1))}/24"
+    return f"{socket.inet_ntop(socket.AF_INET6, prefix + bytes(10))}/48"
+
+
+def _route_source(dest_ip: str, ip_protocol: str) -> str:
+    """Source address the kernel routes dest_ip from, '' if there is no route"""
+    family = socket.AF_INET6 if ip_protocol == '6' else socket.AF_INET
+    try:
+        # connect() on a UDP socket sends nothing; the socket is fresh each time because
+        # a connected UDP socket keeps the source address of its first route
+        with socket.socket(family, socket.SOCK_DGRAM) as sock:
+            sock.connect((dest_ip, 80))
+            return sock.getsockname()[0]
+    except OSError:
+        return ''
+
+
+class ParsedReply(NamedTuple):
+    src_ip: str         # address that sent the reply
+    icmp_type: int      # None for a TCP response from the target itself
+    icmp_code: int
+    dest_ip: str        # destination of the probe the reply refers to
+    proto: str          # protocol of that probe: 'udp', 'tcp' or 'icmp'
+    identifier: int     # probe source port (udp/tcp) or ICMP identifier
+    seq: int            # probe destination port (udp), TCP sequence number or ICMP sequence
+    transport: memoryview  # ICMP message in the receive ring, used for extension parsing
+    recv_time: float    # time.monotonic() at which the kernel received the reply
+    reply_ttl: Optional[int] = None  # TTL / hop limit left in the reply when it arrived
+
+
+class ReplyDemux:
+    """
+    Process-wide receive engine. A single raw ICMP socket and receiver thread per
+    address family parse every reply once and hand it to the trace registered for
+    (dest IP, proto, identifier), instead of every Traceroute parsing every packet.
+    A raw TCP socket next to it catches the SYN-ACK or RST a target sends to TCP probes.
+    """
+    _instances = {}
+    _instances_lock = Lock()
+
+    def __init__(self, family: int):
+        self.family = family
+        self.sock = None
+        self.tcp_sock = None
+        self.thread = None
+        self.stop = None
+        self.running = False
+        self.users = 0
+        # Serialises start-up and shutdown, so a new receiver thread only starts once the
+        # previous one has been joined and its sockets closed
+        self.lifecycle = Lock()
+        self.routes = {}
+        self.sinks = []
+        self.lock = Lock()
+        self.kernel_timestamps = False
+        self.kernel_filter = platform.system() == 'Linux'
+        self.ring = [memoryview(bytearray(REPLY_BUFFER_SIZE)) for _ in range(REPLY_RING_SLOTS)]
+        self.ring_pos = 0
+
+    @classmethod
+    def get(cls, ip_protocol: str) -> 'ReplyDemux':
+        family = socket.AF_INET6 if ip_protocol == '6' else socket.AF_INET
+        with cls._instances_lock:
+            if family not in cls._instances:
+                cls._instances[family] = cls(family)
+            return cls._instances[family]
+
+    def acquire(self):
+        """Take a reference on the engine, starting the socket and thread on first use"""
+        with self.lifecycle, self.lock:
+            if self.users == 0:
+                self.sock = self._create_socket()
+                self.tcp_sock = self._create_tcp_socket()
+                self.running = True
+                # Each receiver thread gets its own stop event; a later acquire can never
+                # revive a thread that release has already told to stop
+                self.stop = threading.Event()
+                self.thread = threading.Thread(target=self._receiver_thread,
+                                               args=(self.stop, self._sockets(), self.tcp_sock),
+                                               name="traceroute-recv", daemon=True)
+                self.thread.start()
+            self.users += 1
+
+    def release(self):
+        with self.lifecycle:
+            with self.lock:
+                self.users -= 1
+                if self.users > 0:
+                    return
+                self.running = False
+                self.stop.set()
+                thread, sockets = self.thread, self._sockets()
+                self.thread = self.stop = self.sock = self.tcp_sock = None
+
+            if thread is not threading.current_thread():
+                thread.join(timeout=2)
+            for sock in sockets:
+                try:
+                    sock.close()
+                except:
+                    pass
 
+    def _sockets(self) -> list:
+        return [sock for sock in (self.sock, self.tcp_sock) if sock is not None]
+
+    def register(self, key: tuple, handler: Callable[[ParsedReply], None]) -> bool:
+        """Route replies for key = (dest_ip, proto, identifier) to handler"""
+        with self.lock:
+            if key in self.routes:
+                return False
+            self.routes[key] = handler
+            self._update_filter()
+            return True
+
+    def unregister(self, key: tuple):
+        with self.lock:
+            if self.routes.pop(key, None) is not None:
+                self._update_filter()
+
+    def add_sink(self, handler: Callable[[ParsedReply], None]):
+        """Receive every parsed reply that no registered route claims"""
+        with self.lock:
+            self.sinks = self.sinks + [handler]
+            self._update_filter()
+
+    def remove_sink(self, handler: Callable[[ParsedReply], None]):
+        with self.lock:
+            self.sinks = [h for h in self.sinks if h != handler]
+            self._update_filter()
+
+    def _update_filter(self):
+        """Rebuild the kernel filter after the routes or sinks changed. Caller holds self.lock"""
+        if self.family != socket.AF_INET:
+            return
+        if self.sock is not None:
+            self._attach_filter(self.sock, self._build_filter())
+        if self.tcp_sock is not None:
+            self._attach_filter(self.tcp_sock, self._build_tcp_filter())
+
+    def _attach_filter(self, sock: socket.socket, program: list):
+        """
+        Attach a classic BPF program so that only replies to registered traces reach
+        Python; pings and other tools' traffic are dropped in the kernel. Destination
+        addresses are still checked by _dispatch. Falls back to no filter where
+        SO_ATTACH_FILTER is unavailable.
+        """
+        if not self.kernel_filter:
+            return
+
+        try:
+            if len(program) > BPF_MAXINSNS:
+                # Too many concurrent traces to list; let _dispatch do the filtering
+                sock.setsockopt(socket.SOL_SOCKET, SO_DETACH_FILTER, 0)
+                return
+            insns = ctypes.create_string_buffer(b''.join(_BPF_INSN.pack(*insn) for insn in program))
+            fprog = _BPF_PROG.pack(len(program), ctypes.addressof(insns))
+            sock.setsockopt(socket.SOL_SOCKET, SO_ATTACH_FILTER, fprog)
+        except OSError:
+            # No filter attached, or detaching one that never was
+            if len(program) <= BPF_MAXINSNS:
+                self.kernel_filter = False
+
+    def _build_filter(self) -> list:
+        """
+        Pass Echo Replies carrying a registered ICMP identifier and Time Exceeded /
+        Destination Unreachable messages quoting a registered (proto, identifier)
+        """
+        idents = {'udp': set(), 'tcp': set(), 'icmp': set()}
+        for _, proto, identifier in self.routes:
+            idents[proto].add(identifier)
+        # Sinks (stateless mode) decode their own signatures, so only the ICMP type is checked
+        match_any = bool(self.sinks)
+
+        code = []
+        labels = {}
+
+        def label(name):
+            labels[name] = len(code)
+
+        def goto_if(value, target):
+            code.append((BPF_JEQ, 0, 1, value))
+            code.append((BPF_JA, 0, 0, target))
+
+        def accept_any_of(values):
+            if match_any:
+                code.append((BPF_RET, 0, 0, BPF_ACCEPT))
+                return
+            for value in sorted(values):
+                code.append((BPF_JEQ, 0, 1, value))
+                code.append((BPF_RET, 0, 0, BPF_ACCEPT))
+            code.append((BPF_RET, 0, 0, 0))
+
+        # X = IP header length, A = ICMP type
+        code.append((BPF_LDX_MSH, 0, 0, 0))
+        code.append((BPF_LDB_IND, 0, 0, 0))
+        goto_if(0, 'echo')
+        goto_if(3, 'error')
+        goto_if(11, 'error')
+        code.append((BPF_RET, 0, 0, 0))
+
+        label('echo')
+        code.append((BPF_LDH_IND, 0, 0, 4))
+        accept_any_of(idents['icmp'])
+
+        # Quoted protocol into A, X = offset of the quoted transport header minus 8
+        label('error')
+        code.append((BPF_LDB_IND, 0, 0, 8 + 9))
+        code.append((BPF_ST, 0, 0, 0))
+        code.append((BPF_LDB_IND, 0, 0, 8))
+        code.append((BPF_AND, 0, 0, 0x0F))
+        code.append((BPF_LSH, 0, 0, 2))
+        code.append((BPF_ADD_X, 0, 0, 0))
+        code.append((BPF_TAX, 0, 0, 0))
+        code.append((BPF_LD_MEM, 0, 0, 0))
+        goto_if(socket.IPPROTO_UDP, 'udp')
+        goto_if(socket.IPPROTO_TCP, 'tcp')
+        goto_if(socket.IPPROTO_ICMP, 'icmp')
+        code.append((BPF_RET, 0, 0, 0))
+
+        for proto in ('udp', 'tcp'):
+            label(proto)
+            code.append((BPF_LDH_IND, 0, 0, 8))  # quoted source port
+            accept_any_of(idents[proto])
+
+        label('icmp')
+        code.append((BPF_LDB_IND, 0, 0, 8))  # quoted type must be Echo Request
+        code.append((BPF_JEQ, 1, 0, 8))
+        code.append((BPF_RET, 0, 0, 0))
+        code.append((BPF_LDH_IND, 0, 0, 8 + 4))
+        accept_any_of(idents['icmp'])
+
+        # Resolve jump labels into offsets relative to the next instruction
+        return [(op, jt, jf, labels[k] - i - 1 if op == BPF_JA else k)
+                for i, (op, jt, jf, k) in enumerate(code)]
+
+    def _build_tcp_filter(self) -> list:
+        """Pass segments addressed to the source port of a registered TCP trace"""
+        if self.sinks:
+            return [(BPF_RET, 0, 0, BPF_ACCEPT)]
+
+        code = [(BPF_LDX_MSH, 0, 0, 0), (BPF_LDH_IND, 0, 0, 2)]
+        for port in sorted({identifier for _, proto, identifier in self.routes if proto == 'tcp'}):
+            code.append((BPF_JEQ, 0, 1, port))
+            code.append((BPF_RET, 0, 0, BPF_ACCEPT))
+        code.append((BPF_RET, 0, 0, 0))
+        return code
+
+    def _create_socket(self) -> socket.socket:
+        if self.family == socket.AF_INET6:
+            sock = socket.socket(socket.AF_INET6, socket.SOCK_RAW, socket.IPPROTO_ICMPV6)
+        else:
+            sock = socket.socket(socket.AF_INET, socket.SOCK_RAW, socket.IPPROTO_ICMP)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.bind(('', 0))
+
+        # On Linux, we need to enable receiving the TTL/hop limit
+        if platform.system() == 'Linux':
+            if self.family == socket.AF_INET6:
+                sock.setsockopt(socket.IPPROTO_IPV6, socket.IPV6_RECVHOPLIMIT, 1)
+            else:
+                sock.setsockopt(socket.SOL_IP, 12, 1)  # IP_RECVTTL
+
+            # Have the kernel stamp each reply on arrival so that time spent queued
+            # behind a busy receiver does not end up in the RTT
+            try:
+                sock.setsockopt(socket.SOL_SOCKET, SO_TIMESTAMPNS, 1)
+                self.kernel_timestamps = True
+            except OSError:
+                self.kernel_timestamps = False
+
+            if self.family == socket.AF_INET:
+                self._attach_filter(sock, self._build_filter())
+        return sock
+
+    def _create_tcp_socket(self) -> Optional[socket.socket]:
+        """Raw TCP socket for target responses to TCP probes; None where unavailable"""
+        try:
+            sock = socket.socket(self.family, socket.SOCK_RAW, socket.IPPROTO_TCP)
+        except OSError:
+            return None
+        if platform.system() == 'Linux':
+            try:
+                sock.setsockopt(socket.SOL_SOCKET, SO_TIMESTAMPNS, 1)
+            except OSError:
+                pass
+            if self.family == socket.AF_INET:
+                self._attach_filter(sock, self._build_tcp_filter())
+        return sock
+
+    def _receiver_thread(self, stop: threading.Event, sockets: list, tcp_sock: Optional[socket.socket]):
+        while not stop.is_set():
+            try:
+                ready, _, _ = select.select(sockets, [], [], 0.1)
+                for sock in ready:
+                    self._receive_one(sock, sock is tcp_sock)
+            except (socket.timeout, ConnectionResetError, BlockingIOError):
+                continue
+            except OSError as e:
+                if stop.is_set():
+                    break
+                # Every trace in the process depends on this thread; report the error and
+                # keep receiving, pausing briefly so a persistent one does not spin
+                Traceroute._print_warning(f"Reply receiver error: {e}")
+                stop.wait(0.1)
+
+    def _receive_one(self, sock: socket.socket, tcp: bool):
+        # Replies land in the next slot of a preallocated ring and are parsed in place;
+        # a handler's view of the packet stays valid until the ring wraps around
+        view = self.ring[self.ring_pos]
+        self.ring_pos = (self.ring_pos + 1) % len(self.ring)
+
+        if not self.kernel_timestamps:
+            nbytes, addr = sock.recvfrom_into(view)
+            self._dispatch(view[:nbytes], addr, time.monotonic(), tcp)
+            return
+
+        nbytes, ancdata, _, addr = sock.recvmsg_into([view], _ANCBUF_SIZE)
+        # IPv4 replies carry their TTL in the IP header, IPv6 ones only in a control message
+        hop_limit = self._cmsg_hop_limit(ancdata) if self.family == socket.AF_INET6 else None
+        self._dispatch(view[:nbytes], addr, self._kernel_recv_time(ancdata), tcp, hop_limit)
+
+    @staticmethod
+    def _cmsg_hop_limit(ancdata: list) -> Optional[int]:
+        for level, type_, data in ancdata:
+            if level == socket.IPPROTO_IPV6 and type_ == socket.IPV6_HOPLIMIT and len(data) >= 4:
+                return struct.unpack('@i', data[:4])[0]
+        return None
+
+    @staticmethod
+    def _kernel_recv_time(ancdata: list) -> float:
+        """Map the SCM_TIMESTAMPNS wall-clock stamp onto the monotonic clock used for send stamps"""
+        now = time.monotonic()
+        for level, type_, data in ancdata:
+            if level == socket.SOL_SOCKET and type_ == SO_TIMESTAMPNS and len(data) >= _TIMESPEC.size:
+                sec, nsec = _TIMESPEC.unpack_from(data)
+                # Only the queueing delay is taken from the wall clock, so clock steps
+                # between send and receive do not affect the RTT
+                queued = time.time() - (sec + nsec * 1e-9)
+                if 0 <= queued < 60:
+                    return now - queued
+                break
+        return now
+
+    def _dispatch(self, packet: memoryview, addr: tuple, recv_time: float, tcp: bool = False,
+                  hop_limit: Optional[int] = None):
+        try:
+            if tcp:
+                reply = self._parse_tcp_reply(packet, addr[0], recv_time, hop_limit)
+            elif self.family == socket.AF_INET6:
+                reply = self._parse_ipv6_reply(packet, addr[0], recv_time, hop_limit)
+            else:
+                reply = self._parse_ipv4_reply(packet, addr[0], recv_time)
+        except (struct.error, IndexError, OSError):
+            return
+        if reply is None:
+            return
+
+        handler = self.routes.get((reply.dest_ip, reply.proto, reply.identifier))
+        if handler is not None:
+            handler(reply)
+            return
+        for sink in self.sinks:
+            sink(reply)
+
+    def _parse_tcp_reply(self, packet: memoryview, src_ip: str, recv_time: float,
+                         hop_limit: Optional[int] = None) -> Optional[ParsedReply]:
+        """A SYN-ACK or RST from the target acknowledges the sequence number of our SYN"""
+        # Raw IPv4 sockets include the IP header, raw IPv6 sockets do not
+        tcp = (packet[0] & 0x0F) * 4 if self.family == socket.AF_INET else 0
+        if len(packet) - tcp < 20:
+            return None
+
+        flags = packet[tcp + 13]
+        if not flags & 0x10 or not flags & 0x06:  # ACK together with SYN or RST
+            return None
+        _, dport, _ = _TCP_PORTS_SEQ.unpack_from(packet, tcp)
+        ack = _U32.unpack_from(packet, tcp + 8)[0]
+        return ParsedReply(src_ip, None, None, src_ip, 'tcp', dport, (ack - 1) & 0xFFFFFFFF,
+                           packet[tcp:], recv_time, packet[8] if tcp else hop_limit)
+
+    @staticmethod
+    def _parse_ipv4_reply(packet: memoryview, src_ip: str, recv_time: float) -> Optional[ParsedReply]:
+        # Fields are read at offsets into the receive buffer; only the quoted
+        # destination address is copied out
+        icmp = (packet[0] & 0x0F) * 4
+        length = len(packet)
+        if length - icmp < 8:
+            return None
+
+        type_, code = packet[icmp], packet[icmp + 1]
+        ttl = packet[8]
+
+        # ICMP Echo Reply (response to an ICMP probe)
+        if type_ == 0:
+            ident, seq = _U16_PAIR.unpack_from(packet, icmp + 4)
+            return ParsedReply(src_ip, type_, code, src_ip, 'icmp', ident, seq, packet[icmp:], recv_time, ttl)
+
+        # ICMP errors quote the original IP header plus at least 8 bytes of the probe
+        if type_ in (3, 11) and length - icmp >= 28:
+            orig_ip = icmp + 8
+            orig_proto = packet[orig_ip + 9]
+            orig_transport = orig_ip + (packet[orig_ip] & 0x0F) * 4
+            if length - orig_transport < 8:
+                return None
+            orig_dst_ip = socket.inet_ntoa(packet[orig_ip + 16:orig_ip + 20])
+
+            if orig_proto == socket.IPPROTO_UDP:
+                orig_sport, orig_dport = _U16_PAIR.unpack_from(packet, orig_transport)
+                return ParsedReply(src_ip, type_, code, orig_dst_ip, 'udp',
+                                   orig_sport, orig_dport, packet[icmp:], recv_time, ttl)
+
+            if orig_proto == socket.IPPROTO_TCP:
+                orig_sport, _, orig_seq = _TCP_PORTS_SEQ.unpack_from(packet, orig_transport)
+                return ParsedReply(src_ip, type_, code, orig_dst_ip, 'tcp',
+                                   orig_sport, orig_seq, packet[icmp:], recv_time, ttl)
+
+            if orig_proto == socket.IPPROTO_ICMP and packet[orig_transport] == 8:
+                ident, seq = _U16_PAIR.unpack_from(packet, orig_transport + 4)
+                return ParsedReply(src_ip, type_, code, orig_dst_ip, 'icmp', ident, seq, packet[icmp:], recv_time,
+                                   ttl)
+
+        return None
+
+    @staticmethod
+    def _parse_ipv6_reply(packet: memoryview, src_ip: str, recv_time: float,
+                          hop_limit: Optional[int] = None) -> Optional[ParsedReply]:
+        # Raw ICMPv6 sockets deliver the message without the IPv6 header
+        if len(packet) < 8:
+            return None
+
+        type_, code = packet[0], packet[1]
+
+        # ICMPv6 Echo Reply
+        if type_ == 129:
+            ident, seq = _U16_PAIR.unpack_from(packet, 4)
+            return ParsedReply(src_ip, type_, code, src_ip, 'icmp', ident, seq, packet, recv_time, hop_limit)
+
+        # ICMPv6 errors (Destination Unreachable, Time Exceeded)
+        if type_ in (1, 3) and len(packet) >= 56:
+            orig_next_header = packet[8 + 6]
+            orig_dst_ip = socket.inet_ntop(socket.AF_INET6, packet[8 + 24:8 + 40])
+
+            if orig_next_header == socket.IPPROTO_UDP:
+                orig_sport, orig_dport = _U16_PAIR.unpack_from(packet, 48)
+                return ParsedReply(src_ip, type_, code, orig_dst_ip, 'udp',
+                                   orig_sport, orig_dport, packet, recv_time, hop_limit)
+
+            if orig_next_header == socket.IPPROTO_TCP:
+                orig_sport, _, orig_seq = _TCP_PORTS_SEQ.unpack_from(packet, 48)
+                return ParsedReply(src_ip, type_, code, orig_dst_ip, 'tcp',
+                                   orig_sport, orig_seq, packet, recv_time, hop_limit)
+
+            if orig_next_header == socket.IPPROTO_ICMPV6 and packet[48] == 128:
+                ident, seq = _U16_PAIR.unpack_from(packet, 52)
+                return ParsedReply(src_ip, type_, code, orig_dst_ip, 'icmp', ident, seq, packet, recv_time,
+                                   hop_limit)
+
+        return None
+
+
+class AsyncReplyDemux(ReplyDemux):
+    """ReplyDemux driven by an asyncio loop reader instead of a receiver thread"""
+    _loop_instances = weakref.WeakKeyDictionary()
+
+    def __init__(self, family: int, loop: asyncio.AbstractEventLoop):
+        super().__init__(family)
+        self.loop = loop
+
+    @classmethod
+    def get_for_loop(cls, ip_protocol: str, loop: asyncio.AbstractEventLoop) -> 'AsyncReplyDemux':
+        family = socket.AF_INET6 if ip_protocol == '6' else socket.AF_INET
+        with cls._instances_lock:
+            per_loop = cls._loop_instances.setdefault(loop, {})
+            if family not in per_loop:
+                per_loop[family] = cls(family, loop)
+            return per_loop[family]
+
+    def acquire(self):
+        with self.lock:
+            if self.users == 0:
+                self.sock = self._create_socket()
+                self.tcp_sock = self._create_tcp_socket()
+                self.running = True
+                for sock in self._sockets():
+                    sock.setblocking(False)
+                    self.loop.add_reader(sock.fileno(), self._on_readable, sock)
+            self.users += 1
+
+    def release(self):
+        with self.lock:
+            self.users -= 1
+            if self.users > 0:
+                return
+            self.running = False
+            sockets = self._sockets()
+            self.sock = self.tcp_sock = None
+
+        for sock in sockets:
+            self.loop.remove_reader(sock.fileno())
+            try:
+                sock.close()
+            except:
+                pass
+
+    def _on_readable(self, sock: socket.socket):
+        # Drain everything queued; the reader fires again when more arrives
+        while self.running:
+            try:
+                self._receive_one(sock, sock is self.tcp_sock)
+            except (BlockingIOError, InterruptedError):
+                return
+            except OSError as e:
+                if e.errno == errno.ECONNRESET:
+                    continue
+                return
+
+
+class TokenBucket:
+    """
+    Token bucket kept as a schedule (GCRA): instead of counting tokens, it tracks the
+    theoretical time of the next conforming send, so a send can be booked ahead.
+    """
+
+    def __init__(self, rate: float, burst: int = 1):
+        self.interval = 1.0 / rate
+        self.tolerance = (max(burst, 1) - 1) * self.interval
+        self.tat = 0.0
+
+    def earliest(self, now: float) -> float:
+        return max(now, self.tat - self.tolerance)
+
+    def book(self, at: float):
+        self.tat = max(self.tat, at) + self.interval
+
+
+class PacingScheduler:
+    """
+    Process-wide send scheduler shared by every trace. Each probe books a release time
+    that satisfies the global pps cap, the cap for its destination prefix (/24 or /48)
+    and the cap for the router expected to answer it, i.e. the one that answered the
+    same prefix at the same TTL before. Callers wait for that deadline, then send.
+    """
+    _instance = None
+    _instance_lock = Lock()
+    MAX_BUCKETS = 4096
+
+    def __init__(self):
+        self.lock = Lock()
+        self.max_pps = self.prefix_pps = self.router_pps = 0
+        self.global_bucket = None
+        self.prefix_buckets = {}
+        self.router_buckets = {}
+        self.hop_routers = {}      # (dest prefix, ttl) -> last responding router
+
+    @classmethod
+    def get(cls) -> 'PacingScheduler':
+        with cls._instance_lock:
+            if cls._instance is None:
+                cls._instance = cls()
+            return cls._instance
+
+    def configure(self, max_pps: int, prefix_pps: int, router_pps: int):
+        """Set the caps in probes per second, 0 = unlimited. Buckets restart on a change"""
+        with self.lock:
+            if (max_pps, prefix_pps, router_pps) == (self.max_pps, self.prefix_pps, self.router_pps):
+                return
+            self.max_pps, self.prefix_pps, self.router_pps = max_pps, prefix_pps, router_pps
+            self.global_bucket = TokenBucket(max_pps, self._burst(max_pps)) if max_pps else None
+            self.prefix_buckets = {}
+            self.router_buckets = {}
+
+    @staticmethod
+    def _burst(rate: int) -> int:
+        # Allow about 10 ms worth of probes back to back
+        return max(1, rate // 100)
+
+    def reserve(self, dest_ip: str, ttl: int, not_before: float = 0.0) -> float:
+        """Book the next send slot for a probe to dest_ip at ttl and return its monotonic deadline"""
+        with self.lock:
+            now = time.monotonic()
+            if not (self.global_bucket or self.prefix_pps or self.router_pps):
+                return max(now, not_before)
+
+            buckets = []
+            if self.global_bucket:
+                buckets.append(self.global_bucket)
+            prefix = _address_prefix(dest_ip)
+            if self.prefix_pps:
+                buckets.append(self._bucket(self.prefix_buckets, prefix, self.prefix_pps, now))
+            router = self.hop_routers.get((prefix, ttl))
+            if self.router_pps and router:
+                buckets.append(self._bucket(self.router_buckets, router, self.router_pps, now))
+
+            at = max(now, not_before, *(bucket.earliest(now) for bucket in buckets))
+            for bucket in buckets:
+                bucket.book(at)
+            return at
+
+    def _bucket(self, buckets: dict, key, rate: int, now: float) -> TokenBucket:
+        bucket = buckets.get(key)
+        if bucket is None:
+            if len(buckets) >= self.MAX_BUCKETS:
+                # Idle buckets are full again and can be recreated on demand
+                for idle in [k for k, b in buckets.items() if b.tat <= now]:
+                    del buckets[idle]
+            bucket = buckets[key] = TokenBucket(rate, self._burst(rate))
+        return bucket
+
+    def learn_router(self, dest_ip: str, ttl: int, router: str):
+        if not self.router_pps:
+            return
+        with self.lock:
+            if len(self.hop_routers) >= 16 * self.MAX_BUCKETS:
+                self.hop_routers.clear()
+            self.hop_routers[(_address_prefix(dest_ip), ttl)] = router
+
+
+class RttEstimator:
+    """Smoothed RTT and RTT variance as in TCP's retransmission timer (RFC 6298), in seconds"""
+    ALPHA = 1 / 8
+    BETA = 1 / 4
+    K = 4
+
+    def __init__(self):
+        self.srtt = None
+        self.rttvar = 0.0
+
+    def sample(self, rtt: float):
+        if self.srtt is None:
+            self.srtt, self.rttvar = rtt, rtt / 2
+        else:
+            self.rttvar += self.BETA * (abs(self.srtt - rtt) - self.rttvar)
+            self.srtt += self.ALPHA * (rtt - self.srtt)
+
+    def timeout(self) -> Optional[float]:
+        if self.srtt is None:
+            return None
+        return self.srtt + self.K * self.rttvar
+
+
+class PrefixRttTable:
+    """
+    Process-wide RTT estimates per destination prefix (/24 or /48), so that a trace can
+    start from what earlier traces to the same prefix observed before it has samples of its own.
+    """
+    _instance = None
+    _instance_lock = Lock()
+    MAX_PREFIXES = 4096
+
+    def __init__(self):
+        self.lock = Lock()
+        self.estimators = {}
+
+    @classmethod
+    def get(cls) -> 'PrefixRttTable':
+        with cls._instance_lock:
+            if cls._instance is None:
+                cls._instance = cls()
+            return cls._instance
+
+    def sample(self, dest_ip: str, rtt: float):
+        prefix = _address_prefix(dest_ip)
+        with self.lock:
+            estimator = self.estimators.get(prefix)
+            if estimator is None:
+                if len(self.estimators) >= self.MAX_PREFIXES:
+                    # Forget the oldest prefix
+                    del self.estimators[next(iter(self.estimators))]
+                estimator = self.estimators[prefix] = RttEstimator()
+            estimator.sample(rtt)
+
+    def timeout(self, dest_ip: str) -> Optional[float]:
+        with self.lock:
+            estimator = self.estimators.get(_address_prefix(dest_ip))
+            return estimator.timeout() if estimator else None
+
+
+class PrefixDistanceTable:
+    """
+    Process-wide hop distance per destination prefix (/24 or /48), learned from the
+    remaining TTL of replies sent by destinations. Bounds traces to silent targets.
+    """
+    _instance = None
+    _instance_lock = Lock()
+    MAX_PREFIXES = 4096
+
+    def __init__(self):
+        self.lock = Lock()
+        self.distances = {}
+
+    @classmethod
+    def get(cls) -> 'PrefixDistanceTable':
+        with cls._instance_lock:
+            if cls._instance is None:
+                cls._instance = cls()
+            return cls._instance
+
+    def record(self, dest_ip: str, distance: int):
+        prefix = _address_prefix(dest_ip)
+        with self.lock:
+            if prefix not in self.distances and len(self.distances) >= self.MAX_PREFIXES:
+                del self.distances[next(iter(self.distances))]
+            self.distances[prefix] = distance
+
+    def get_distance(self, dest_ip: str) -> Optional[int]:
+        with self.lock:
+            return self.distances.get(_address_prefix(dest_ip))
+
+
+class ProtocolPreferenceTable:
+    """
+    Probes sent and answered per protocol and destination prefix, kept in a JSON file across
+    runs. Traces lead with the protocol their prefix answers best and fall back to the rest
+    of the probe sequence only at hops where it stays silent.
+    """
+    _instances = {}
+    _instances_lock = Lock()
+    HALVE_AT = 64  # counts are halved past this many probes, so older runs weigh less
+
+    def __init__(self, path: str):
+        self.path = path
+        self.lock = Lock()
+        self.dirty = False
+        try:
+            with open(path) as f:
+                self.prefixes = json.load(f)  # prefix label -> proto -> [sent, answered]
+        except (OSError, ValueError):
+            self.prefixes = {}
+
+    @classmethod
+    def get(cls, path: str) -> 'ProtocolPreferenceTable':
+        path = os.path.abspath(path)
+        with cls._instances_lock:
+            table = cls._instances.get(path)
+            if table is None:
+                table = cls._instances[path] = cls(path)
+            return table
+
+    def preferred(self, dest_ip: str, protocols: list) -> Optional[str]:
+        with self.lock:
+            counts = self.prefixes.get(_prefix_label(dest_ip), {})
+            rates = {proto: counts[proto][1] / counts[proto][0]
+                     for proto in protocols if proto in counts and counts[proto][1]}
+        return max(rates, key=rates.get) if rates else None
+
+    def record(self, dest_ip: str, proto: str, sent: int, answered: int):
+        with self.lock:
+            counts = self.prefixes.setdefault(_prefix_label(dest_ip), {}).setdefault(proto, [0, 0])
+            counts[0] += sent
+            counts[1] += answered
+            if counts[0] > self.HALVE_AT:
+                counts[0], counts[1] = counts[0] / 2, counts[1] / 2
+            self.dirty = True
+
+    def save(self):
+        with self.lock:
+            if not self.dirty:
+                return
+            # Write a sibling file and rename it, so a crash never leaves half a table
+            tmp_path = f"{self.path}.tmp"
+            with open(tmp_path, 'w') as f:
+                json.dump(self.prefixes, f, sort_keys=True)
+            os.replace(tmp_path, self.path)
+            self.dirty = False
+
+
+class StopSet:
+    """
+    Doubletree stop sets shared by the traces of a batch. Forward probing stops at an
+    interface already seen on the way to the same destination prefix (global stop
+    set); backward probing stops at an interface already seen at the same TTL (local
+    stop set), since the paths near the vantage point form a tree.
+    """
 
-class Traceroute:
     def __init__(self):
+        self.lock = Lock()
+        self.local = set()         # (interface, ttl)
+        self.global_pairs = set()  # (interface, destination prefix)
+
+    def visit(self, interfaces: set, ttl: int, dest_ip: str, forward: bool) -> bool:
+        """Record the interfaces of a hop; return True if the hop was already known"""
+        prefix = _address_prefix(dest_ip)
+        with self.lock:
+            if forward:
+                known = any((interface, prefix) in self.global_pairs for interface in interfaces)
+            else:
+                known = any((interface, ttl) in self.local for interface in interfaces)
+            for interface in interfaces:
+                self.local.add((interface, ttl))
+                self.global_pairs.add((interface, prefix))
+            return known
+
+
+@dataclass
+class TraceOptions:
+    """
+    Trace settings, one field per command line option. Validate once with validate()
+    and share the object across a batch; with_target() gives the per-target copy.
+    """
+    host: Optional[str] = None
+    input_file: Optional[str] = None
+    ipv4: bool = False
+    ipv6: bool = False
+    source: Optional[str] = None
+    tos: int = 0
+    dont_fragment: bool = False
+    first_hop: int = 1
+    max_hops: int = 30
+    gateway: Optional[List[str]] = None
+    protocol: str = "udp"
+    sport: Optional[int] = None
+    port: Optional[int] = None
+    probe_sequence: List[str] = field(default_factory=lambda: ["udp", "tcp", "icmp"])
+    packet_size: int = 64
+    wait: int = 5000
+    queries: int = 1
+    z: float = 0
+    series_count: int = 1
+    series_interval: int = 100
+    window: int = 1
+    adaptive_wait: bool = False
+    min_wait: int = 100
+    preflight: bool = False
+    adaptive_queries: bool = False
+    rtt_confidence: float = 0.0
+    protocol_table: Optional[str] = None
+    max_pps: int = 0
+    prefix_pps: int = 0
+    router_pps: int = 0
+    halt_on: List[str] = field(default_factory=lambda: ["unreachable", "prohibited"])
+    gap_limit: int = 5
+    doubletree_start: int = 0
+    no_resolve: bool = False
+    verbose: bool = False
+    extensions: bool = False
+    simulate: bool = False
+    mtu: bool = False
+    stateless: bool = False
+    pps: int = 1000
+    unprivileged: bool = False
+
+    @classmethod
+    def from_dict(cls, options: dict) -> 'TraceOptions':
+        """Build options from a dict of option names; unknown names are ignored"""
+        names = {f.name for f in fields(cls)}
+        return cls(**{name: value for name, value in options.items() if name in names})
+
+    def with_target(self, host: str) -> 'TraceOptions':
+        return replace(self, host=host, input_file=None)
+
+    def validate(self) -> 'TraceOptions':
+        """Check value ranges and combinations; raises ValueError"""
+        if self.mtu:
+            self.dont_fragment = True
+
+        # Validate numeric ranges
+        for param in [(self.tos, 0, 255, "TOS"),
+                      (self.first_hop, 1, 255, "First hop TTL"),
+                      (self.max_hops, 1, 255, "Max hops"),
+                      (self.port, 1, 65535, "Port") if self.port else (None, None, None, None),
+                      (self.sport, 1, 65535, "Source port") if self.sport else (None, None, None, None),
+                      (self.wait, 0, None, "Wait time"),
+                      (self.queries, 1, None, "Queries per hop"),
+                      (self.window, 1, 255, "TTL window"),
+                      # --min-wait only bounds adaptive timeouts
+                      (self.min_wait, 0, self.wait, "Minimum wait time") if self.adaptive_wait else (None, None, None, None),
+                      (self.rtt_confidence, 0, 1, "RTT confidence target"),
+                      (self.gap_limit, 0, 255, "Gap limit"),
+                      (self.doubletree_start, 0, 255, "Doubletree start TTL"),
+                      (self.max_pps, 0, None, "Global probe rate"),
+                      (self.prefix_pps, 0, None, "Per-prefix probe rate"),
+                      (self.router_pps, 0, None, "Per-router probe rate"),
+                      (self.pps, 1, None, "Probe rate"),
+                      (self.z, 0, None, "Probe interval")]:
+            if param[0] is not None and (param[0] < param[1] or (param[2] is not None and param[0] > param[2])):
+                raise ValueError(f"{param[3]} must be between {param[1]} and {param[2]} (got {param[0]})")
+
+        for proto in [self.protocol] + list(self.probe_sequence):
+            if proto not in ("icmp", "udp", "tcp"):
+                raise ValueError(f"Unsupported protocol: {proto}")
+        for rule in self.halt_on:
+            if rule not in ("unreachable", "prohibited"):
+                raise ValueError(f"Unknown halt rule: {rule}")
+
+        if self.protocol == "icmp" and (self.port or self.sport):
+            raise ValueError("ICMP protocol cannot specify port numbers")
+        return self
+
+
+class Traceroute:
+    def __init__(self, options: Optional[TraceOptions] = None, session: Optional['TraceSession'] = None):
 
         # Initialize state variables
         self.reached = False
         self.results = {}
-        self.probes_sent = {}
+        self.probes_sent = {}      # probe id -> outstanding probe, dropped once answered or expired
+        self.probe_index = {}      # (proto, identifier, wire seq) -> outstanding probe
+        self.probe_deadlines = []  # heap of (deadline, index key)
+        self.wire_seq = 0
         self.recv_running = False
         self.lock = Lock()
-        self.recv_sock = None
+        self.reply_cond = threading.Condition(self.lock)
+        self.hop_pending = {}      # ttl -> probes still waiting for a reply
+        self.hop_deadline = {}     # ttl -> deadline of the last probe sent at that TTL
+        self.hop_sent = {}         # (ttl, proto) -> probes sent, failed sends included
+        self.stop_reason = None    # termination rule that ended the trace early
+        self.stop_ttl = None
+        self.silent_hops = 0
+        self.stop_set = None       # Doubletree stop set, shared when set by TracerouteHandler
+        self.backward_stop_ttl = None
+        self.demux = None
+        self.demux_keys = []
+        self.icmp_ident = None
+        self.unprivileged = False
+        self.reader_thread = None
+        self.socks = {}            # protocol -> send socket
         self.sock = None
+        self.session = session     # TraceSession owning the send sockets, if any
+        self.session_socks = False
+        self.send_lock = Lock()    # TTL is a socket option; shared sockets set it under this lock
+        if options is not None:
+            # Embedded use: options are taken as given, validated once by the caller
+            self.options = options
+            return
         try:
             self.options = self._parse_args()
         except SystemExit as e:
@@ -44,14 +1141,35 @@ class Traceroute:
         # Initialize sockets
         self._init_sockets()
 
+        # Lead with the protocol this prefix answered before; needs the final probe sequence
+        self._init_protocol_preference()
+
         # print(self.__dict__)
 
     def _init_basic_parameters(self):
         self.queries_per_hop = self.options.queries
+        self.adaptive_queries = self.options.adaptive_queries
+        self.rtt_confidence = self.options.rtt_confidence
         self.timeout = self.options.wait / 1000.0
+        self.adaptive_wait = self.options.adaptive_wait
+        self.min_timeout = self.options.min_wait / 1000.0
+        self.rtt = RttEstimator()
+        self.rtt_table = PrefixRttTable.get()
+        self.preflight = self.options.preflight
+        self.hop_distance = None
+        self.distance_table = PrefixDistanceTable.get()
         self.min_send_interval = self.options.z / 1000.0
         self.max_hops = self.options.max_hops
         self.first_ttl = self.options.first_hop
+        self.window = self.options.window
+        self.halt_on = set(self.options.halt_on)
+        self.gap_limit = self.options.gap_limit
+        self.doubletree_start = self.options.doubletree_start
+        if self.doubletree_start and self.stop_set is None:
+            self.stop_set = StopSet()
+        self.pacer = PacingScheduler.get()
+        self.pacer.configure(self.options.max_pps, self.options.prefix_pps, self.options.router_pps)
+        self.next_send = 0.0
         self.flag_no_resolve = self.options.no_resolve
         self.flag_simulate = self.options.simulate
         self.flag_mtu_test = self.options.mtu
@@ -80,6 +1198,7 @@ class Traceroute:
         self.src_port = self.options.sport or random.randint(32768, 61000)
         self.protocol = self.options.protocol.lower()
         self.packet_size = self.options.packet_size
+        self.unprivileged = self.options.unprivileged
 
     def _init_output_parameters(self):
 
@@ -88,17 +1207,9 @@ class Traceroute:
         self.series_interval = self.options.series_interval / 1000.0
 
     def _get_default_source_ip(self) -> str:
-        try:
-            if self.ip_protocol == '4':
-                s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-                s.connect((self.dest_ip, 80))
-                return s.getsockname()[0]
-            else:
-                s = socket.socket(socket.AF_INET6, socket.SOCK_DGRAM)
-                s.connect((self.dest_ip, 80))
-                return s.getsockname()[0]
-        except Exception:
-            return ''
+        if self.session is not None:
+            return self.session.source_for(self.dest_ip, self.ip_protocol)
+        return _route_source(self.dest_ip, self.ip_protocol)
 
     @staticmethod
     def _print_warning(text: str):
@@ -120,7 +1231,7 @@ class Traceroute:
             raise ValueError(f"Unable to resolve host {self.options.host}: {e}")
 
     @staticmethod
-    def _parse_args() -> argparse.Namespace:
+    def _parse_args(argv: Optional[List[str]] = None) -> TraceOptions:
         parser = argparse.ArgumentParser(description="Advanced Python Traceroute Implementation")
 
         # Target specification
@@ -166,12 +1277,51 @@ class Traceroute:
                             help="Wait time for response in milliseconds")
         parser.add_argument("-q", "--queries", type=int, default=1,
                             help="Number of probes that every series will sent for any protocol contains.")
-        parser.add_argument("-z", type=int, default=0,
-                            help="Minimum interval between probes in milliseconds")
+        parser.add_argument("-z", type=float, default=0,
+                            help="Minimum interval between probes in milliseconds (fractions allowed)")
+        parser.add_argument("--adaptive-queries", action="store_true",
+                            help="Send one probe per protocol per hop, then more only where all went "
+                                 "unanswered or --rtt-confidence is not met; -q becomes the maximum")
+        parser.add_argument("--rtt-confidence", type=float, default=0.0,
+                            help="With --adaptive-queries, keep probing an answering hop until the 95%% "
+                                 "confidence interval of its mean RTT is within this fraction of the mean (0 = off)")
+        parser.add_argument("--protocol-table", metavar="PATH",
+                            help="JSON file of per-/24 protocol answer rates, updated after every trace; "
+                                 "hops are probed with the best protocol first, the others only on silence")
         parser.add_argument("--series-count", type=int, default=1,
                             help="Number of probe series per hop")
         parser.add_argument("--series-interval", type=int, default=100,
                             help="Interval between probe series in milliseconds")
+        parser.add_argument("--window", type=int, default=1,
+                            help="Number of TTLs kept in flight at once (1 = probe hop by hop)")
+        parser.add_argument("--adaptive-wait", action="store_true",
+                            help="Time probes out after the smoothed RTT plus 4 deviations seen on this "
+                                 "trace or its /24, between --min-wait and --wait")
+        parser.add_argument("--min-wait", type=int, default=100,
+                            help="Lower bound for --adaptive-wait timeouts in milliseconds")
+        parser.add_argument("--preflight", action="store_true",
+                            help="Send one full-TTL probe first and bound the trace by the hop distance "
+                                 "inferred from the TTL left in the target's reply; without it, a distance "
+                                 "learned earlier for the target's /24 still bounds the trace")
+
+        # Rate limits, shared by all traces of the process
+        parser.add_argument("--max-pps", type=int, default=0,
+                            help="Global cap on probes per second across all traces (0 = unlimited)")
+        parser.add_argument("--prefix-pps", type=int, default=0,
+                            help="Cap on probes per second towards one destination /24 (/48 for IPv6)")
+        parser.add_argument("--router-pps", type=int, default=0,
+                            help="Cap on probes per second expected to be answered by one router")
+
+        # Termination options; reaching the destination always ends a trace
+        parser.add_argument("--halt-on", nargs='*', choices=["unreachable", "prohibited"],
+                            default=["unreachable", "prohibited"],
+                            help="Stop on port/protocol unreachable from the destination "
+                                 "and/or on administratively prohibited from any hop; no value disables both")
+        parser.add_argument("--gap-limit", type=int, default=5,
+                            help="Stop after this many consecutive hops without any reply (0 = never)")
+        parser.add_argument("--doubletree-start", type=int, default=0,
+                            help="Doubletree: probe forward from this TTL, then backward, stopping at "
+                                 "hops already known to the batch's stop set (0 = off)")
 
         # Output options
         parser.add_argument("-n", "--no-resolve", action="store_true",
@@ -185,63 +1335,120 @@ class Traceroute:
         parser.add_argument("--mtu", action="store_true",
                             help="Discover MTU along path (implies -F -N 1)")
 
-        args = parser.parse_args()
-
-        # Post-processing and validation
-        if args.mtu:
-            args.dont_fragment = True
-
-        # Validate numeric ranges
-        for param in [(args.tos, 0, 255, "TOS"),
-                      (args.first_hop, 1, 255, "First hop TTL"),
-                      (args.max_hops, 1, 255, "Max hops"),
-                      (args.port, 1, 65535, "Port") if args.port else (None, None, None, None),
-                      (args.sport, 1, 65535, "Source port") if args.sport else (None, None, None, None),
-                      (args.wait, 0, None, "Wait time"),
-                      (args.queries, 1, None, "Queries per hop"),
-                      (args.z, 0, None, "Probe interval")]:
-            if param[0] is not None and (param[0] < param[1] or (param[2] is not None and param[0] > param[2])):
-                parser.error(f"{param[3]} must be between {param[1]} and {param[2]} (got {param[0]})")
+        # Stateless mode options
+        parser.add_argument("--stateless", action="store_true",
+                            help="Probe (target, TTL) pairs of --input-file in random order without "
+                                 "per-probe state (yarrp style, IPv4 only)")
+        parser.add_argument("--pps", type=int, default=1000,
+                            help="Probes per second in --stateless mode")
 
-        if args.protocol == "icmp" and (args.port or args.sport):
-            parser.error("ICMP protocol cannot specify port numbers")
+        parser.add_argument("--unprivileged", action="store_true",
+                            help="Trace without raw sockets (Linux): UDP probes or ICMP ping sockets, "
+                                 "errors read from the socket's IP_RECVERR queue")
 
-        return args
+        args = parser.parse_args(argv)
+        try:
+            return TraceOptions(**vars(args)).validate()
+        except ValueError as e:
+            parser.error(str(e))
 
     def _init_sockets(self):
         try:
-            self.sock = self._create_send_socket()
-            self.recv_sock = self._create_recv_socket()
-            self._config_socket_options()
+            if self.session is not None:
+                self.session_socks = self.session.lease(self)
+                if not self.session_socks and not self.options.sport:
+                    # Another trace to this destination holds the session's source port
+                    self.src_port = random.randint(32768, 61000)
+            # One send socket per protocol in the probe sequence, so that a single pass over
+            # the TTLs can interleave udp, tcp and icmp probes
+            for proto in self._probe_protocols() if not self.session_socks else ():
+                sock = self._create_send_socket(proto)
+                self.socks[proto] = sock
+                self._config_socket_options(sock)
+            self.probe_sequence = [proto for proto in self.probe_sequence if proto in self.socks]
         except Exception as e:
             # self._print_warning(f"Failed to initialize sockets: {str(e)}")
             sys.exit(1)
 
-    def _create_send_socket(self) -> socket.socket:
-        if self.protocol == 'tcp':
-            trans_protocol = socket.SOCK_STREAM
+    def _init_protocol_preference(self):
+        self.protocol_table = None
+        self.lead_protocol = None
+        if self.options.protocol_table:
+            self.protocol_table = ProtocolPreferenceTable.get(self.options.protocol_table)
+            if len(self.probe_sequence) > 1:
+                self.lead_protocol = self.protocol_table.preferred(self.dest_ip, self.probe_sequence)
+
+    def _record_protocol_answers(self):
+        if self.protocol_table is None:
+            return
+        for proto in self.probe_sequence:
+            probes = [probe for ttl, hop in self.results.items() if isinstance(ttl, int)
+                      for probe in hop[proto]['probes']]
+            if probes:
+                answered = sum(1 for probe in probes if probe['from'])
+                self.protocol_table.record(self.dest_ip, proto, len(probes), answered)
+        if self.session is None:
+            # A session writes the table once when it closes
+            self.protocol_table.save()
+
+    def _probe_protocols(self) -> list:
+        protocols = list(dict.fromkeys(self.probe_sequence))
+        if self.unprivileged and 'tcp' in protocols and len(protocols) > 1:
+            self._print_warning("TCP probes need raw sockets, skipping them in --unprivileged mode")
+            protocols.remove('tcp')
+        if self.unprivileged and 'icmp' in protocols and len(protocols) > 1 and not self._ping_socket_allowed():
+            self._print_warning("ICMP ping sockets are not permitted for this group by "
+                                "net.ipv4.ping_group_range, skipping ICMP probes in --unprivileged mode")
+            protocols.remove('icmp')
+        return protocols
+
+    def _ping_socket_allowed(self) -> bool:
+        family = socket.AF_INET6 if self.ip_protocol == '6' else socket.AF_INET
+        ip_proto = socket.IPPROTO_ICMPV6 if self.ip_protocol == '6' else socket.IPPROTO_ICMP
+        try:
+            socket.socket(family, socket.SOCK_DGRAM, ip_proto).close()
+        except PermissionError:
+            return False
+        return True
+
+    def _create_send_socket(self, proto: str) -> socket.socket:
+        if proto == 'tcp':
+            # TCP probes are prebuilt SYN packets written to a raw socket
+            trans_protocol = socket.SOCK_RAW
             ip_proto = socket.IPPROTO_TCP
-        elif self.protocol == 'udp':
+        elif proto == 'udp':
             trans_protocol = socket.SOCK_DGRAM
             ip_proto = socket.IPPROTO_UDP
-        elif self.protocol == 'icmp':
+        elif proto == 'icmp':
             trans_protocol = socket.SOCK_RAW
-            ip_proto = socket.IPPROTO_ICMP
+            ip_proto = socket.IPPROTO_ICMPV6 if self.ip_protocol == '6' else socket.IPPROTO_ICMP
         else:
-            raise ValueError(f"Unsupported protocol: {self.protocol}")
+            raise ValueError(f"Unsupported protocol: {proto}")
 
         family = socket.AF_INET6 if self.ip_protocol == '6' else socket.AF_INET
         while True:
             try:
+                if self.unprivileged:
+                    return self._create_unprivileged_socket(family, proto)
+
                 sock = socket.socket(family, trans_protocol, ip_proto)
+                if trans_protocol == socket.SOCK_RAW:
+                    self._drop_received(sock)
                 sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+                if proto == 'tcp' and family == socket.AF_INET:
+                    # The IPv4 header comes from the probe template, TTL included
+                    sock.setsockopt(socket.IPPROTO_IP, socket.IP_HDRINCL, 1)
 
                 # Bind to source IP if specified
                 if self.src_ip:
                     sock.bind((self.src_ip, self.src_port))
                 return sock
             except PermissionError as e:
-                self._print_warning(f"Permission denied: {e}. Try running as root.")
+                if self.unprivileged and proto == 'icmp':
+                    self._print_warning(f"Permission denied: {e}. Ping sockets need the caller's group "
+                                        f"within net.ipv4.ping_group_range.")
+                else:
+                    self._print_warning(f"Permission denied: {e}. Try running as root.")
                 sys.exit(1)
             except socket.error as e:
                 self.src_port = random.randint(32768, 61000)
@@ -249,64 +1456,79 @@ class Traceroute:
                 self._print_warning(f"Failed to create send socket: {e}")
                 sys.exit(1)
 
-    def _create_recv_socket(self) -> socket.socket:
+    @staticmethod
+    def _drop_received(sock: socket.socket):
+        """
+        A raw send socket gets a copy of every ICMP or TCP packet the host receives, yet
+        replies are read by ReplyDemux; a filter returning 0 drops them all in the kernel
+        """
+        if platform.system() != 'Linux':
+            return
+        insns = ctypes.create_string_buffer(_BPF_INSN.pack(BPF_RET, 0, 0, 0))
         try:
-            family = socket.AF_INET6 if self.ip_protocol == '6' else socket.AF_INET
-
-            if self.protocol == 'icmp':
-                proto = socket.IPPROTO_ICMP
-            elif self.protocol == 'udp':
-                proto = socket.IPPROTO_ICMP  # For UDP we get ICMP responses
-            else:  # TCP
-                proto = socket.IPPROTO_TCP
-
-            sock = socket.socket(family, socket.SOCK_RAW, proto)
-            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-
-            sock.settimeout(self.timeout)
-            sock.bind(('', 0))
+            sock.setsockopt(socket.SOL_SOCKET, SO_ATTACH_FILTER, _BPF_PROG.pack(1, ctypes.addressof(insns)))
+        except OSError:
+            pass
+
+    def _create_unprivileged_socket(self, family: int, proto: str) -> socket.socket:
+        """
+        UDP socket or ICMP ping socket that needs no privileges. ICMP errors caused by its
+        probes are queued on the socket itself (IP_RECVERR) and read with MSG_ERRQUEUE.
+        """
+        if proto == 'udp':
+            sock = socket.socket(family, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
+        elif proto == 'icmp':
+            # Ping socket; the caller's group must be within net.ipv4.ping_group_range
+            ip_proto = socket.IPPROTO_ICMPV6 if family == socket.AF_INET6 else socket.IPPROTO_ICMP
+            sock = socket.socket(family, socket.SOCK_DGRAM, ip_proto)
+        else:
+            raise ValueError("TCP probes need raw sockets; run as root or use -P udp/icmp")
 
-            # On Linux, we need to enable receiving the TTL/hop limit
-            if platform.system() == 'Linux':
-                sock.setsockopt(socket.SOL_IP, 12, 1) # IP_RECVTTL
-                if self.ip_protocol == '6':
-                    sock.setsockopt(socket.IPPROTO_IPV6, socket.IPV6_RECVHOPLIMIT, 1)
+        if family == socket.AF_INET6:
+            sock.setsockopt(socket.IPPROTO_IPV6, IPV6_RECVERR, 1)
+        else:
+            sock.setsockopt(socket.SOL_IP, IP_RECVERR, 1)
+        try:
+            sock.setsockopt(socket.SOL_SOCKET, SO_TIMESTAMPNS, 1)
+        except OSError:
+            pass
 
-            return sock
-        except Exception as e:
-            self._print_warning(f"Failed to create receive socket: {e}")
-            sys.exit(1)
+        sock.bind((self.src_ip or '', self.src_port if proto == 'udp' else 0))
+        if proto == 'icmp':
+            # The kernel writes the ping socket's port into every echo identifier
+            self.icmp_ident = sock.getsockname()[1]
+        return sock
 
-    def _config_socket_options(self):
+    def _config_socket_options(self, sock: socket.socket):
         # Set TOS/DSCP
         if self.type_of_service:
             if self.ip_protocol == '4':
-                self.sock.setsockopt(socket.IPPROTO_IP, socket.IP_TOS, self.type_of_service)
+                sock.setsockopt(socket.IPPROTO_IP, socket.IP_TOS, self.type_of_service)
             else:
-                self.sock.setsockopt(socket.IPPROTO_IPV6, socket.IPV6_TCLASS, self.type_of_service)
+                sock.setsockopt(socket.IPPROTO_IPV6, socket.IPV6_TCLASS, self.type_of_service)
 
         # Set Don't Fragment flag
         if self.flag_df:
             if self.ip_protocol == '4':
                 if platform.system() == 'Linux':
-                    self.sock.setsockopt(socket.IPPROTO_IP, 10, 2)  # IP_MTU_DISCOVER
+                    sock.setsockopt(socket.IPPROTO_IP, 10, 2)  # IP_MTU_DISCOVER
                 elif platform.system() == 'Windows':
-                    self.sock.setsockopt(socket.IPPROTO_IP, 14, 1)  # IP_DONTFRAGMENT
+                    sock.setsockopt(socket.IPPROTO_IP, 14, 1)  # IP_DONTFRAGMENT
                 else:  # macOS/BSD
-                    self.sock.setsockopt(socket.IPPROTO_IP, 67, 1)  # IP_DONTFRAG
+                    sock.setsockopt(socket.IPPROTO_IP, 67, 1)  # IP_DONTFRAG
             else:  # IPv6
                 if platform.system() == 'Linux':
-                    self.sock.setsockopt(socket.IPPROTO_IPV6, 10, 2) # IPV6_MTU_DISCOVER
+                    sock.setsockopt(socket.IPPROTO_IPV6, 10, 2) # IPV6_MTU_DISCOVER
                 elif platform.system() == 'Windows':
-                    self.sock.setsockopt(socket.IPPROTO_IPV6, 14, 1) # IPV6_DONTFRAG
+                    sock.setsockopt(socket.IPPROTO_IPV6, 14, 1) # IPV6_DONTFRAG
                 else:  # macOS/BSD
-                    self.sock.setsockopt(socket.IPPROTO_IPV6, 62, 1)  # IPV6_DONTFRAG
+                    sock.setsockopt(socket.IPPROTO_IPV6, 62, 1)  # IPV6_DONTFRAG
 
         # Configure Loose Source Routing if specified
         if self.LSRR_list:
-            self._config_source_routing()
+            self._config_source_routing(sock)
 
-    def _config_source_routing(self):
+    def _config_source_routing(self, sock: socket.socket):
         if self.ip_protocol == '4':
             if len(self.LSRR_list) > 8:
                 raise ValueError("Too many gateways for IPv4 LSRR (max 8)")
@@ -324,7 +1546,7 @@ class Traceroute:
             option = struct.pack('BBBB', 0x83, len(route_data) + 3, init_ptr, 0) + route_data
 
             try:
-                self.sock.setsockopt(socket.SOL_IP, socket.IP_OPTIONS, option)
+                sock.setsockopt(socket.SOL_IP, socket.IP_OPTIONS, option)
             except socket.error as e:
                 self._print_warning(f"Failed to set LSRR option: {e}")
                 sys.exit(1)
@@ -342,7 +1564,7 @@ class Traceroute:
                     sys.exit(1)
 
             try:
-                self.sock.setsockopt(socket.IPPROTO_IPV6, socket.IPV6_RTHDR, header)
+                sock.setsockopt(socket.IPPROTO_IPV6, socket.IPV6_RTHDR, header)
             except socket.error as e:
                 self._print_warning(f"Failed to set IPv6 routing header: {e}")
                 sys.exit(1)
@@ -367,92 +1589,547 @@ class Traceroute:
         self.init()
 
         try:
-            with ThreadPoolExecutor(max_workers=1) as executor:
-                # Start receiver thread first
-                recv_future = executor.submit(self._receiver_thread)
-
-                # Wait for receiver to initialize
-                start_time = time.time()
-                while not self.recv_running and (time.time() - start_time) < 1:
-                    time.sleep(0.1)
-
-                if not self.recv_running:
-                    raise RuntimeError("Receiver thread failed to start")
+            # Attach to the shared receiver before the first probe goes out
+            self._start_receiver()
+            self._init_probe_templates()
 
-                try:
-                    # Send probes for each TTL
-                    for ttl in range(self.first_ttl, self.first_ttl + self.max_hops):
-                        self._probe_hop(ttl)
+            try:
+                # A distance learned for the target's prefix bounds the trace up front;
+                # the preflight probe refines it with the target's own
+                self._apply_hop_distance()
+                if self.preflight and self._send_preflight():
+                    self._wait_for_hop(PREFLIGHT_TTL)
+                    self._apply_hop_distance()
 
-                        # Check if we've reached the target
-                        if self._check_target_reached(ttl):
-                            break
+                # Send probes for each TTL, self.window hops at a time
+                self._run_window()
 
-                except KeyboardInterrupt:
-                    print("\nTrace interrupted by user")
-                finally:
-                    self.recv_running = False
-                    recv_future.result(timeout=2)
+            except KeyboardInterrupt:
+                print("\nTrace interrupted by user")
 
         except Exception as e:
             self._print_warning(f"Traceroute failed: {e}")
         finally:
             self.close()
+            with self.lock:
+                # Whatever is still outstanding never got an answer
+                self._expire_probes(float('inf'))
+            self._trim_beyond_target()
+            self._sort_hops()
+            self._record_protocol_answers()
             self._display_final_results()
             return self.results
 
+    def _run_window(self):
+        for ttls, forward in self._probe_phases():
+            self._run_ttls(ttls, forward)
+
+    def _probe_phases(self) -> list:
+        """
+        TTL ranges to probe as (ttls, forward). With a Doubletree stop set, probing goes
+        forward from the mid-path start TTL, then backward from just below it.
+        """
+        last_ttl = self.first_ttl + self.max_hops - 1
+        if self.stop_set is None:
+            return [(range(self.first_ttl, last_ttl + 1), True)]
+
+        start = min(max(self.doubletree_start, self.first_ttl), last_ttl)
+        return [(range(start, last_ttl + 1), True),
+                (range(start - 1, self.first_ttl - 1, -1), False)]
+
+    def _run_ttls(self, ttls: range, forward: bool):
+        """
+        Keep up to self.window TTLs in flight and retire them in probing order. A hop is
+        retired as soon as all its probes are answered or their deadline passes, so
+        a window of 1 probes hop by hop without idling on hops that answered fast.
+        """
+        ttls = iter(ttls)
+        next_ttl = next(ttls, None)
+        in_flight = deque()
+
+        while True:
+            # No new TTLs once the phase is over (destination reached, halt rule, stop set)
+            while len(in_flight) < self.window and next_ttl is not None and not self._phase_done(forward):
+                self._probe_hop(next_ttl)
+                in_flight.append(next_ttl)
+                next_ttl = next(ttls, None)
+
+            if not in_flight:
+                break
+
+            ttl = in_flight.popleft()
+            self._wait_for_hop(ttl)
+            retries = self._hop_retries(ttl)
+            while retries:
+                self._send_paced(ttl, retries)
+                self._wait_for_hop(ttl)
+                retries = self._hop_retries(ttl)
+            if self._retire_hop(ttl, forward):
+                break
+
+    def _phase_done(self, forward: bool) -> bool:
+        return self._halted() if forward else self.backward_stop_ttl is not None
+
+    def _retire_hop(self, ttl: int, forward: bool) -> bool:
+        """Apply the stop rules to a finished hop; True ends the current phase"""
+        if not forward:
+            return self._check_stop_set(ttl, forward)
+        return self._check_target_reached(ttl) or self._check_halt(ttl) or self._check_stop_set(ttl, forward)
+
+    def _check_stop_set(self, ttl: int, forward: bool) -> bool:
+        """Doubletree: record the hop's interfaces and stop on reaching known territory"""
+        if self.stop_set is None or ttl not in self.results:
+            return False
+
+        interfaces = {probe['from'] for proto in ('udp', 'tcp', 'icmp')
+                      for probe in self.results[ttl][proto]['probes'] if probe['from']}
+        if not self.stop_set.visit(interfaces, ttl, self.dest_ip, forward):
+            return False
+        if forward:
+            self.stop_reason, self.stop_ttl = 'stop_set', ttl
+        else:
+            self.backward_stop_ttl = ttl
+        return True
+
+    def _halted(self) -> bool:
+        return self.reached or self.stop_reason is not None
+
+    def _check_halt(self, ttl: int) -> bool:
+        """Apply the termination rules to a hop retired in TTL order"""
+        if self.stop_ttl is not None and ttl >= self.stop_ttl:
+            return True
+
+        if self.gap_limit:
+            silent = ttl not in self.results or not any(
+                probe['from'] for proto in ('udp', 'tcp', 'icmp') for probe in self.results[ttl][proto]['probes'])
+            self.silent_hops = self.silent_hops + 1 if silent else 0
+            if self.silent_hops >= self.gap_limit:
+                self.stop_reason, self.stop_ttl = 'gap_limit', ttl
+                return True
+        return False
+
+    def _halt_reason(self, reply: ParsedReply) -> Optional[str]:
+        """Termination rule triggered by a reply, if any"""
+        if reply.icmp_type is None:
+            return None
+        # A firewall on the path rejecting with port unreachable sends it from its own
+        # address, so only the destination's own unreachables end the trace
+        from_destination = reply.src_ip == reply.dest_ip
+        if self.ip_protocol == '6':
+            unreachable = from_destination and reply.icmp_type == 1 and reply.icmp_code == 4
+            prohibited = reply.icmp_type == 1 and reply.icmp_code == 1
+        else:
+            unreachable = from_destination and reply.icmp_type == 3 and reply.icmp_code in (2, 3)
+            prohibited = reply.icmp_type == 3 and reply.icmp_code in (9, 10, 13)
+
+        if unreachable and 'unreachable' in self.halt_on:
+            return 'unreachable'
+        if prohibited and 'prohibited' in self.halt_on:
+            return 'prohibited'
+        return None
+
+    def _wait_for_hop(self, ttl: int):
+        """Block until every probe sent at ttl is answered or its deadline has passed"""
+        with self.reply_cond:
+            while self.hop_pending.get(ttl, 0) > 0:
+                now = time.monotonic()
+                self._expire_probes(now)
+                remaining = self.hop_deadline[ttl] - now
+                if remaining <= 0:
+                    break
+                self.reply_cond.wait(remaining)
+
+    def _trim_beyond_target(self, results: Optional[dict] = None):
+        """Drop hops past the first TTL that reached the target or halted the trace (probed while in flight)"""
+        results = self.results if results is None else results
+        last_ttls = [ttl for ttl in results
+                     if isinstance(ttl, int) and self._check_target_reached(ttl, results)]
+        if results is self.results and self.stop_ttl is not None:
+            last_ttls.append(self.stop_ttl)
+        if last_ttls:
+            for ttl in [t for t in results if isinstance(t, int) and t > min(last_ttls)]:
+                del results[ttl]
+
+    def _sort_hops(self):
+        """Store hops in TTL order; backward probing records them out of order"""
+        self.results = {ttl: self.results[ttl] for ttl in sorted(self.results)}
+
+    def _get_demux(self) -> ReplyDemux:
+        return ReplyDemux.get(self.ip_protocol)
+
+    def _start_receiver(self):
+        if self.unprivileged:
+            # The kernel already demultiplexes errors per socket, no shared raw socket needed
+            self.recv_running = True
+            self._start_socket_reader()
+            return
+
+        self.demux = self._get_demux()
+        self.demux.acquire()
+        self.recv_running = True
+
+        # Replies are routed by (dest IP, proto, identifier): the bound source port
+        # identifies UDP/TCP probes, a per-trace identifier identifies ICMP probes
+        for proto in ('udp', 'tcp'):
+            key = (self.dest_ip, proto, self.src_port)
+            if self.demux.register(key, self._on_reply):
+                self.demux_keys.append(key)
+
+        ident = threading.get_ident() & 0xFFFF
+        while not self.demux.register((self.dest_ip, 'icmp', ident), self._on_reply):
+            ident = random.randint(1, 0xFFFF)
+        self.icmp_ident = ident
+        self.demux_keys.append((self.dest_ip, 'icmp', ident))
+
+    def _stop_receiver(self):
+        if self.unprivileged:
+            if self.recv_running:
+                self.recv_running = False
+                self._stop_socket_reader()
+            return
+
+        if not self.demux:
+            return
+        for key in self.demux_keys:
+            self.demux.unregister(key)
+        self.demux_keys = []
+        if self.recv_running:
+            self.recv_running = False
+            self.demux.release()
+
+    def _start_socket_reader(self):
+        self.reader_thread = threading.Thread(target=self._socket_reader_thread, daemon=True)
+        self.reader_thread.start()
+
+    def _stop_socket_reader(self):
+        if self.reader_thread is not threading.current_thread():
+            self.reader_thread.join(timeout=2)
+
+    def _socket_reader_thread(self):
+        protos = {sock: proto for proto, sock in self.socks.items()}
+        while self.recv_running:
+            try:
+                # Queued errors make a socket readable as well
+                ready, _, _ = select.select(list(protos), [], [], 0.1)
+            except (OSError, ValueError):
+                break
+            for sock in ready:
+                self._read_socket_replies(sock, protos[sock])
+
+    def _read_socket_replies(self, sock: socket.socket, proto: str):
+        """Drain ICMP errors from a send socket's error queue, and echo replies on ping sockets"""
+        while True:
+            try:
+                data, ancdata, _, addr = sock.recvmsg(REPLY_BUFFER_SIZE, _ERRQUEUE_ANCBUF_SIZE,
+                                                      socket.MSG_ERRQUEUE | socket.MSG_DONTWAIT)
+            except (BlockingIOError, InterruptedError):
+                break
+            except OSError:
+                return
+            reply = self._parse_queued_error(proto, data, ancdata, addr)
+            if reply is not None:
+                self._on_reply(reply)
+
+        while True:
+            try:
+                data, ancdata, _, addr = sock.recvmsg(REPLY_BUFFER_SIZE, _ANCBUF_SIZE, socket.MSG_DONTWAIT)
+            except (BlockingIOError, InterruptedError):
+                break
+            except OSError as e:
+                # A pending ICMP error is reported once by the next receive call
+                if e.errno in (errno.EBADF, errno.ENOTSOCK):
+                    return
+                continue
+
+            # Ordinary datagrams on UDP sockets (the target answering) are discarded
+            if proto == 'icmp' and len(data) >= 8 and data[0] in (0, 129):
+                ident, seq = _U16_PAIR.unpack_from(data, 4)
+                self._on_reply(ParsedReply(addr[0], data[0], data[1], addr[0], 'icmp', ident, seq,
+                                           memoryview(data), ReplyDemux._kernel_recv_time(ancdata)))
+
+    def _parse_queued_error(self, proto: str, data: bytes, ancdata: list, addr: tuple) -> Optional[ParsedReply]:
+        """
+        Build a reply from an error queue message. addr is the probe's destination, data
+        the probe's payload; the ICMP sender follows the sock_extended_err header.
+        """
+        for level, type_, cmsg in ancdata:
+            if (level, type_) not in ((socket.SOL_IP, IP_RECVERR), (socket.IPPROTO_IPV6, IPV6_RECVERR)):
+                continue
+
+            _, origin, icmp_type, icmp_code, _, _, _ = _SOCK_EXTENDED_ERR.unpack_from(cmsg)
+            if origin not in (SO_EE_ORIGIN_ICMP, SO_EE_ORIGIN_ICMP6):
+                return None
+            offender = cmsg[_SOCK_EXTENDED_ERR.size:]
+            if level == socket.SOL_IP:
+                src_ip = socket.inet_ntoa(offender[4:8])
+            else:
+                src_ip = socket.inet_ntop(socket.AF_INET6, offender[8:24])
+            recv_time = ReplyDemux._kernel_recv_time(ancdata)
+
+            # Extensions are not delivered through the error queue
+            if proto == 'udp':
+                return ParsedReply(src_ip, icmp_type, icmp_code, addr[0], 'udp',
+                                   self.src_port, addr[1], memoryview(b''), recv_time)
+            if len(data) >= 8:
+                ident, seq = _U16_PAIR.unpack_from(data, 4)
+                return ParsedReply(src_ip, icmp_type, icmp_code, addr[0], 'icmp',
+                                   ident, seq, memoryview(b''), recv_time)
+        return None
+
+    def _send_preflight(self, paced: bool = True) -> bool:
+        """One probe that reaches the target; its reply's TTL gives the hop distance"""
+        if paced:
+            _sleep_until(self._reserve_send(PREFLIGHT_TTL))
+        proto = 'icmp' if 'icmp' in self.probe_sequence else self.probe_sequence[0]
+        return self._send_probe(PREFLIGHT_TTL, 0, proto, 1, preflight=True)
+
+    @staticmethod
+    def _infer_hop_distance(reply_ttl: int) -> int:
+        """Hops to a host whose reply arrived with reply_ttl, assuming the usual initial TTLs"""
+        initial = next(ttl for ttl in (32, 64, 128, 255) if ttl >= reply_ttl)
+        return initial - reply_ttl + 1
+
+    def _apply_hop_distance(self):
+        """
+        Bound the TTL range by the target's distance, or by its prefix's until the target's
+        own is known. Bounds derive from the options each time, so a later distance replaces
+        an earlier one rather than narrowing it further
+        """
+        distance = self.hop_distance or self.distance_table.get_distance(self.dest_ip)
+        if distance is None:
+            return
+        # TTLs beyond the target only repeat its reply; start at most at the target
+        self.first_ttl = min(self.options.first_hop, distance)
+        if self.options.doubletree_start:
+            self.doubletree_start = min(self.options.doubletree_start, distance)
+        self.max_hops = min(self.options.max_hops, distance + DISTANCE_SLACK - self.first_ttl + 1)
+
     def _probe_hop(self, ttl: int):
         for series in range(self.series_count):
-            for proto in self.probe_sequence:
-                for seq in range(1, self.queries_per_hop + 1):
-                    if self._send_probe(ttl, series, proto, seq):
-                        time.sleep(self.min_send_interval)
+            self._send_paced(ttl, self._series_probes(series))
 
-            time.sleep(self.series_interval)
+            # Pause between series only; waiting for replies is left to _wait_for_hop
+            if series + 1 < self.series_count:
+                self._delay_next_send(self.series_interval)
 
         # Display results for this hop
         # self._display_current_hop(ttl)
 
-    def _send_probe(self, ttl: int, series: int, proto: str, seq: int) -> bool:
+    def _series_probes(self, series: int) -> list:
+        return [(series, proto, seq) for proto in self._leading_protocols()
+                for seq in range(1, self._initial_queries() + 1)]
+
+    def _send_paced(self, ttl: int, probes: list):
+        """Send (series, proto, seq) probes at their pacer deadlines, batching those due together"""
+        for deadline, batch in self._due_batches(ttl, probes):
+            _sleep_until(deadline)
+            self._send_probe_batch(ttl, batch)
+
+    def _due_batches(self, ttl: int, probes: list):
+        """
+        Book a deadline per probe and group each with the batch before it if already due by
+        the time that batch goes out: probes with the same slot, or a backlog being caught up
+        """
+        batch, first = [], None
+        for probe in probes:
+            deadline = self._reserve_send(ttl)
+            if batch and (deadline > max(first, time.monotonic()) or len(batch) >= SEND_BATCH_MAX):
+                yield first, batch
+                batch = []
+            if not batch:
+                first = deadline
+            batch.append(probe)
+        if batch:
+            yield first, batch
+
+    def _leading_protocols(self) -> list:
+        return [self.lead_protocol] if self.lead_protocol else self.probe_sequence
+
+    def _initial_queries(self) -> int:
+        return 1 if self.adaptive_queries else self.queries_per_hop
+
+    def _hop_retries(self, ttl: int) -> list:
+        """
+        Extra (series, proto, seq) probes for a hop whose probes are all answered or expired.
+        Protocols not probed yet (behind a lead protocol) go out if the hop stayed silent.
+        With --adaptive-queries, one more per protocol that got no reply at all, or whose mean
+        RTT is not yet known to within --rtt-confidence; at most -q per protocol and series.
+        """
+        if not (self.adaptive_queries or self.lead_protocol) or (self.stop_ttl is not None and ttl > self.stop_ttl):
+            return []
+        retries = []
         with self.lock:
-            probe_id = f"{ttl}-{series}-{proto}-{seq}"
-            send_time = time.time()
-            identifier = None
+            hop = self.results.get(ttl)
+            silent = not hop or not any(p['from'] for proto in self.probe_sequence for p in hop[proto]['probes'])
+            for proto in self.probe_sequence:
+                sent = self.hop_sent.get((ttl, proto), 0)
+                if not sent:
+                    if silent:
+                        retries.extend((self.series_count - 1, proto, seq)
+                                       for seq in range(1, self._initial_queries() + 1))
+                    continue
+                if not self.adaptive_queries or sent >= self.queries_per_hop * self.series_count:
+                    continue
+                rtts = [p['rtt'] for p in hop[proto]['probes'] if p['rtt'] is not None] if hop else []
+                if not rtts or (self.rtt_confidence and not self._rtt_confident(rtts)):
+                    retries.append((self.series_count - 1, proto, sent + 1))
+        return retries
+
+    def _rtt_confident(self, rtts: list) -> bool:
+        if len(rtts) < 2:
+            return False
+        half_width = RTT_CONFIDENCE_Z * statistics.stdev(rtts) / len(rtts) ** 0.5
+        return half_width <= self.rtt_confidence * statistics.fmean(rtts)
+
+    def _reserve_send(self, ttl: int) -> float:
+        """Book a release deadline for the next probe with the shared pacer, honoring -z"""
+        release = self.pacer.reserve(self.dest_ip, ttl, self.next_send)
+        # The -z schedule advances from its own slots rather than from late sends, so
+        # probes that fell behind go out back to back until they are on time again
+        slot = release if release - self.next_send > PACER_MAX_LAG else self.next_send
+        self.next_send = slot + self.min_send_interval
+        return release
+
+    def _delay_next_send(self, interval: float):
+        self.next_send = max(self.next_send, time.monotonic() + interval)
+
+    def _send_probe(self, ttl: int, series: int, proto: str, seq: int, preflight: bool = False) -> bool:
+        with self.lock:
+            # Counted up front: a failed send still uses up one of the hop's queries, so
+            # _hop_retries cannot keep asking for a probe that never goes out
+            self.hop_sent[(ttl, proto)] = self.hop_sent.get((ttl, proto), 0) + 1
+            sock = self.socks.get(proto)
+            if sock is None:
+                return False
 
-            # Set TTL
-            if self.ip_protocol == '4':
-                self.sock.setsockopt(socket.SOL_IP, socket.IP_TTL, ttl)
-            else:
-                self.sock.setsockopt(socket.IPPROTO_IPV6, socket.IPV6_UNICAST_HOPS, ttl)
+            # Every probe gets its own sequence number so that a reply maps to exactly one probe
+            self.wire_seq = self.wire_seq % 0xFFFF + 1
 
-            # Send based on protocol
+            # Send based on protocol; stamped on the same monotonic clock as received replies
             try:
+                self.send_lock.acquire()
+                # Set TTL
+                if self.ip_protocol == '4':
+                    sock.setsockopt(socket.SOL_IP, socket.IP_TTL, ttl)
+                else:
+                    sock.setsockopt(socket.IPPROTO_IPV6, socket.IPV6_UNICAST_HOPS, ttl)
+
+                send_time = time.monotonic()
                 if proto == "udp":
-                    self._send_udp_probe(seq)
-                    identifier = self.src_port  # use source port as the identifier
+                    wire_seq = self._send_udp_probe(self.wire_seq)
                 elif proto == "tcp":
-                    self._send_tcp_probe(seq)
-                    identifier = self.src_port # use source port as the identifier
+                    wire_seq = self._send_tcp_probe(self.wire_seq, ttl)
                 elif proto == "icmp":
-                    ident = threading.get_ident() & 0xFFFF  # truncate the thread_id(64bits) to match the length of ICMP identifier
-                    self._send_icmp_probe(seq, ident)
-                    identifier = ident  # use thread_id as the identifier
+                    wire_seq = self._send_icmp_probe(self.wire_seq, self.icmp_ident)
             except Exception as e:
                 if self.flag_verbose:
                     self._print_warning(f"Failed to send {proto} probe: {e}")
                 return False
+            finally:
+                self.send_lock.release()
 
-            self.probes_sent[probe_id] = {
-                'send_time': send_time,
-                'ttl': ttl,
-                'series': series,
-                'proto': proto,
-                'seq': seq,
-                'identifier': identifier,  # 新增字段
-                'matched': False
-            }
+            self._register_probe(ttl, series, proto, seq, wire_seq, send_time, preflight)
+            self._expire_probes(time.monotonic())
         return True
 
+    def _probe_identifier(self, proto: str) -> int:
+        # The bound source port identifies UDP/TCP probes, the per-trace identifier ICMP ones
+        return self.icmp_ident if proto == 'icmp' else self.src_port
+
+    def _register_probe(self, ttl: int, series: int, proto: str, seq: int, wire_seq: int,
+                        send_time: float, preflight: bool = False):
+        """Track a sent probe until its reply or deadline. Caller holds self.lock"""
+        probe_id = f"{ttl}-{series}-{proto}-{seq}"
+        identifier = self._probe_identifier(proto)
+        probe = {
+            'id': probe_id,
+            'send_time': send_time,
+            'ttl': ttl,
+            'series': series,
+            'proto': proto,
+            'seq': seq,
+            'identifier': identifier,  # 新增字段
+            'matched': False,
+            'preflight': preflight
+        }
+        self.probes_sent[probe_id] = probe
+
+        deadline = time.monotonic() + self._probe_timeout()
+        key = (proto, identifier, wire_seq)
+        self.probe_index[key] = probe
+        heapq.heappush(self.probe_deadlines, (deadline, key))
+
+        self.hop_pending[ttl] = self.hop_pending.get(ttl, 0) + 1
+        self.hop_deadline[ttl] = max(deadline, self.hop_deadline.get(ttl, deadline))
+
+    def _send_probe_batch(self, ttl: int, batch: list):
+        """
+        Send (series, proto, seq) probes for one TTL with one sendmmsg call per protocol
+        socket, the TTL riding along as a control message instead of a setsockopt per probe
+        """
+        if len(batch) < 2 or _libc_sendmmsg is None:
+            for series, proto, seq in batch:
+                self._send_probe(ttl, series, proto, seq)
+            return
+
+        with self.lock:
+            by_proto = {}
+            for series, proto, seq in batch:
+                self.hop_sent[(ttl, proto)] = self.hop_sent.get((ttl, proto), 0) + 1
+                if proto not in self.socks:
+                    continue
+                self.wire_seq = self.wire_seq % 0xFFFF + 1
+                packet, address, wire_seq = self._build_probe(proto, ttl, self.wire_seq)
+                # Raw TCP probes carry the TTL in their own IPv4 header
+                hop_limit = None if proto == 'tcp' and self.tcp_offset else ttl
+                by_proto.setdefault(proto, []).append(((series, seq, wire_seq), (packet, address, hop_limit)))
+
+            for proto, probes in by_proto.items():
+                sock = self.socks[proto]
+                messages = [message for _, message in probes]
+                with self.send_lock:
+                    send_time = time.monotonic()
+                    sent = self._sendmmsg(sock, messages)
+                    # Whatever the kernel refused goes out one by one, TTL set per probe
+                    for i in range(sent, len(messages)):
+                        if not self._send_single(sock, *messages[i]):
+                            probes[i] = None
+                for probe in probes:
+                    if probe is not None:
+                        (series, seq, wire_seq), _ = probe
+                        self._register_probe(ttl, series, proto, seq, wire_seq, send_time)
+            self._expire_probes(time.monotonic())
+
+    def _sendmmsg(self, sock: socket.socket, messages: list) -> int:
+        sent = 0
+        retried = False
+        while sent < len(messages):
+            try:
+                sent += _sendmmsg(sock, messages[sent:])
+            except OSError as e:
+                # An ICMP error queued by an earlier probe is reported once, as with _sendto
+                if self.unprivileged and e.errno in _QUEUED_ERRNOS and not retried:
+                    retried = True
+                    continue
+                if self.flag_verbose:
+                    self._print_warning(f"sendmmsg failed, sending one by one: {e}")
+                break
+        return sent
+
+    def _send_single(self, sock: socket.socket, packet: bytes, address: tuple, hop_limit: Optional[int]) -> bool:
+        try:
+            if hop_limit is not None:
+                if self.ip_protocol == '4':
+                    sock.setsockopt(socket.SOL_IP, socket.IP_TTL, hop_limit)
+                else:
+                    sock.setsockopt(socket.IPPROTO_IPV6, socket.IPV6_UNICAST_HOPS, hop_limit)
+            self._sendto(sock, packet, address)
+            return True
+        except OSError as e:
+            if self.flag_verbose:
+                self._print_warning(f"Failed to send probe: {e}")
+            return False
+
     # def _send_probe(self, ttl: int, series: int, proto: str, seq: int) -> bool:
     #     if self.flag_simulate:
     #         return True
@@ -492,38 +2169,107 @@ class Traceroute:
     #
     #     return True
 
-    def _send_udp_probe(self, seq: int):
-        port = self.dest_port + seq - 1
-        if port > 65535:
-            port = (port - 49152) % 16384 + 49152  # Wrap around to dynamic ports
+    def _init_probe_templates(self):
+        """Build each probe once per target; sends only patch the fields that change"""
+        self.udp_payload = b"P" * self.packet_size
 
-        data = b"P" * self.packet_size
-        self.sock.sendto(data, (self.dest_ip, port))
+        ident = self.icmp_ident or 0  # no identifier when ICMP is not probed unprivileged
+        icmp_header = struct.pack("!BBHHH", 8, 0, 0, ident, 0)
+        icmp_data = b"P" * (self.packet_size - len(icmp_header))
+        checksum = self._calculate_checksum(icmp_header + icmp_data)
+        self.icmp_template = bytearray(struct.pack("!BBHHH", 8, 0, checksum, ident, 0) + icmp_data)
 
-    def _send_tcp_probe(self, seq: int):
+        tcp_header = self._build_tcp_header(0)
         if self.ip_protocol == '4':
-            packet = self._build_ipv4_header() + self._build_tcp_header(seq)
+            # Sent through an IP_HDRINCL socket, so the TTL lives in the template
+            self.tcp_offset = 20
+            self.tcp_template = bytearray(self._build_ipv4_header() + tcp_header)
         else:
-            packet = self._build_ipv6_header() + self._build_tcp_header(seq)
-
-        self.sock.sendto(packet, (self.dest_ip, self.dest_port))
+            self.tcp_offset = 0
+            self.tcp_template = bytearray(tcp_header)
 
-    def _send_icmp_probe(self, seq: int, ident: int):
-        checksum = 0
-        header = struct.pack("!BBHHH", 8, 0, checksum, ident, seq)
-        data = b"P" * (self.packet_size - len(header))
-
-        # Calculate checksum
-        checksum = self._calculate_checksum(header + data)
-        header = struct.pack("!BBHHH", 8, 0, checksum, ident, seq)
-
-        self.sock.sendto(header + data, (self.dest_ip, 0))
+    @staticmethod
+    def _checksum_adjust(checksum: int, old_word: int, new_word: int) -> int:
+        """Incremental Internet checksum update for one changed 16-bit word (RFC 1624, eqn. 3)"""
+        total = (~checksum & 0xFFFF) + (~old_word & 0xFFFF) + new_word
+        total = (total & 0xFFFF) + (total >> 16)
+        total = (total & 0xFFFF) + (total >> 16)
+        return ~total & 0xFFFF
+
+    @classmethod
+    def _patch_u16(cls, packet: bytearray, offset: int, value: int, *checksum_offsets: int):
+        """Write a 16-bit field in place and fix up every checksum that covers it"""
+        old = _U16.unpack_from(packet, offset)[0]
+        if old == value:
+            return
+        _U16.pack_into(packet, offset, value)
+        for checksum_offset in checksum_offsets:
+            checksum = _U16.unpack_from(packet, checksum_offset)[0]
+            _U16.pack_into(packet, checksum_offset, cls._checksum_adjust(checksum, old, value))
+
+    @classmethod
+    def _patch_u32(cls, packet: bytearray, offset: int, value: int, *checksum_offsets: int):
+        cls._patch_u16(packet, offset, value >> 16, *checksum_offsets)
+        cls._patch_u16(packet, offset + 2, value & 0xFFFF, *checksum_offsets)
+
+    def _build_probe(self, proto: str, ttl: int, seq: int) -> tuple:
+        """(packet, address, wire seq) of one probe; templates are patched, so packets are copies"""
+        if proto == 'udp':
+            port = self._udp_port(seq)
+            return self.udp_payload, (self.dest_ip, port), port
+        if proto == 'tcp':
+            return bytes(self._patch_tcp_template(seq, ttl)), (self.dest_ip, 0), seq
+        return bytes(self._patch_icmp_template(seq, self.icmp_ident)), (self.dest_ip, 0), seq
+
+    def _udp_port(self, seq: int) -> int:
+        port = self.dest_port + seq - 1
+        if port > 65535:
+            port = (port - 49152) % 16384 + 49152  # Wrap around to dynamic ports
+        return port
+
+    def _patch_tcp_template(self, seq: int, ttl: int) -> bytearray:
+        packet = self.tcp_template
+        offset = self.tcp_offset
+        if offset:
+            # TTL shares a 16-bit word with the protocol field
+            self._patch_u16(packet, 8, (ttl << 8) | socket.IPPROTO_TCP, 10)
+        self._patch_u32(packet, offset + 4, seq, offset + 16)
+        return packet
+
+    def _patch_icmp_template(self, seq: int, ident: int) -> bytearray:
+        packet = self.icmp_template
+        self._patch_u16(packet, 4, ident, 2)
+        self._patch_u16(packet, 6, seq, 2)
+        return packet
+
+    def _send_udp_probe(self, seq: int) -> int:
+        port = self._udp_port(seq)
+        self._sendto(self.socks['udp'], self.udp_payload, (self.dest_ip, port))
+        return port
+
+    def _send_tcp_probe(self, seq: int, ttl: int) -> int:
+        self.socks['tcp'].sendto(self._patch_tcp_template(seq, ttl), (self.dest_ip, 0))
+        return seq
+
+    def _send_icmp_probe(self, seq: int, ident: int) -> int:
+        self._sendto(self.socks['icmp'], self._patch_icmp_template(seq, ident), (self.dest_ip, 0))
+        return seq
+
+    def _sendto(self, sock: socket.socket, packet: bytes, address: tuple):
+        try:
+            sock.sendto(packet, address)
+        except OSError as e:
+            # With IP_RECVERR an ICMP error for an earlier probe is also reported once by
+            # the next send; it is read from the error queue anyway, so send again
+            if not self.unprivileged or e.errno not in _QUEUED_ERRNOS:
+                raise
+            sock.sendto(packet, address)
 
     def _build_ipv4_header(self) -> bytes:
         version_ihl = 0x45  # IPv4, 5 word header
         dscp_ecn = self.type_of_service
         total_len = 40  # 20 byte IP header + 20 byte TCP header
-        ident = random.randint(0, 65535)
+        ident = 0  # Filled in per packet by the kernel
         flags_frag = 0x4000 if self.flag_df else 0  # DF flag
         ttl = 64  # Will be overwritten
         proto = socket.IPPROTO_TCP
@@ -538,7 +2284,7 @@ class Traceroute:
 
         # Checksum
         checksum = self._calculate_checksum(header)
-        return header[:10] + struct.pack("H", checksum) + header[12:]
+        return header[:10] + struct.pack("!H", checksum) + header[12:]
 
     def _build_ipv6_header(self, payload_len: int = 40) -> bytes:
         version = 0x6
@@ -602,138 +2348,109 @@ class Traceroute:
                                         0, socket.IPPROTO_TCP, len(tcp_header))
 
         checksum = self._calculate_checksum(pseudo_header + tcp_header)
-        return tcp_header[:16] + struct.pack("H", checksum) + tcp_header[18:]
-
-    def _receiver_thread(self):
-        self.recv_running = True
-        cnt = 0
-
-        while self.recv_running:
-            try:
-                ready, _, _ = select.select([self.recv_sock], [], [], 0.1)
-                if ready:
-                    try:
-                        packet, addr = self.recv_sock.recvfrom(1024)
-                        self._process_reply_packet(packet, addr)
-                    except socket.timeout:
-                        continue
-                    except ConnectionResetError:
-                        if self.flag_verbose:
-                            self._print_warning("Connection reset by peer")
-                        continue
-            except Exception as e:
-                if self.flag_verbose:
-                    self._print_warning(f"Receiver error: {e}")
-                break
+        return tcp_header[:16] + struct.pack("!H", checksum) + tcp_header[18:]
 
-    def _process_reply_packet(self, packet: bytes, addr: tuple):
+    def _on_reply(self, reply: ParsedReply):
+        """Handle a reply the shared ReplyDemux routed to this trace"""
         try:
-            src_ip = addr[0]
             extensions = {}
+            if self.flag_show_extensions and reply.icmp_type is not None:
+                extensions.update(self._process_icmp_extensions(reply.transport))
 
-            if self.ip_protocol == '4':
-                self._process_ipv4_reply(packet, src_ip, extensions)
-            else:
-                self._process_ipv6_reply(packet, src_ip, extensions)
+            self._match_reply(reply.proto, reply.identifier, reply.seq, reply.src_ip, extensions,
+                              reply.recv_time, self._halt_reason(reply), reply.reply_ttl)
         except Exception as e:
             if self.flag_verbose:
                 self._print_warning(f"Error processing reply: {e}")
 
-    def _process_ipv4_reply(self, packet: bytes, src_ip: str, extensions: dict):
-        ip_header_len = (packet[0] & 0x0F) * 4
-        transport_header = packet[ip_header_len:]
-
-        if self.flag_show_extensions:
-            extensions.update(self._process_icmp_extensions(transport_header))
-
-        # ICMP protocol handling
-        if len(transport_header) >= 8:
-            type_, code = struct.unpack("!BB", transport_header[:2])
-
-            # ICMP Echo Reply (response to our ICMP probe)
-            if type_ == 0 and self.protocol == "icmp":
-                _, _, probe_id, seq = struct.unpack("!HHHH", transport_header[:8])
-                self._match_reply(probe_id, seq, src_ip, extensions)
-
-            # ICMP errors (response to UDP/TCP)
-            elif type_ in (3, 11) and len(transport_header) >= 28:
-                orig_ip_header = transport_header[8:28]
-                orig_dst_ip = socket.inet_ntoa(orig_ip_header[16:20])
-
-                if orig_dst_ip == self.dest_ip:
-                    if self.protocol == "udp":
-                        orig_header = transport_header[28:28 + 8]
-                        orig_sport, orig_dport = struct.unpack("!HH", orig_header[:4])
-                        seq = orig_dport - self.dest_port + 1
-                        self._match_reply(None, seq, src_ip, extensions)
-
-                    elif self.protocol == "tcp":
-                        orig_header = transport_header[28:28 + 20]
-                        orig_sport, orig_dport = struct.unpack("!HH", orig_header[:4])
-                        seq = orig_dport - self.dest_port + 1
-                        self._match_reply(None, seq, src_ip, extensions)
-
-    def _process_ipv6_reply(self, packet: bytes, src_ip: str, extensions: dict):
-        """Process IPv6 reply packet"""
-        # Basic IPv6 header is 40 bytes
-        transport_header = packet[40:]
-
-        if self.flag_show_extensions:
-            extensions.update(self._process_icmp_extensions(transport_header))
-
-        # ICMPv6 handling
-        if len(transport_header) >= 8:
-            type_, code = struct.unpack("!BB", transport_header[:2])
-
-            # ICMPv6 Echo Reply
-            if type_ == 129 and self.protocol == "icmp":
-                _, _, probe_id, seq = struct.unpack("!HHHH", transport_header[:8])
-                self._match_reply(probe_id, seq, src_ip, extensions)
-
-            # ICMPv6 errors (Time Exceeded, Destination Unreachable)
-            elif type_ in (3, 11) and len(transport_header) >= 48:
-                # IPv6 header is 40 bytes, we need to look at the original packet
-                orig_transport = transport_header[48:]
-
-                if self.protocol == "udp" and len(orig_transport) >= 8:
-                    orig_sport, orig_dport = struct.unpack("!HH", orig_transport[:4])
-                    seq = orig_dport - self.dest_port + 1
-                    self._match_reply(None, seq, src_ip, extensions)
-
-                elif self.protocol == "tcp" and len(orig_transport) >= 20:
-                    orig_sport, orig_dport = struct.unpack("!HH", orig_transport[:4])
-                    seq = orig_dport - self.dest_port + 1
-                    self._match_reply(None, seq, src_ip, extensions)
-
-    def _match_reply(self, probe_id: Optional[int], seq: int, src_ip: str, extensions: dict):
+    def _match_reply(self, proto: str, identifier: int, seq: int, src_ip: str, extensions: dict,
+                     recv_time: float, halt: Optional[str] = None, reply_ttl: Optional[int] = None):
         with self.lock:
-            # Try to find matching probe
-            for probe_key, probe in list(self.probes_sent.items()):
-                if (probe['seq'] == seq and
-                        (probe_id is None or ('probe_id' in probe and probe['probe_id'] == probe_id)) and
-                        not probe['matched']):
-                    rtt = (time.time() - probe['send_time']) * 1000
-                    reached = src_ip == self.dest_ip
-                    self.reached = reached
-
-                    self._record_hop_result(
-                        probe['ttl'],
-                        probe['series'],
-                        probe['proto'],
-                        {
-                            'ip': src_ip,
-                            'rtt': rtt,
-                            'reached': reached,
-                            'extensions': extensions
-                        }
-                    )
-
-                    probe['matched'] = True
-                    break
+            # Constant-time lookup; an entry leaves the index once matched or expired
+            probe = self.probe_index.pop((proto, identifier, seq), None)
+            if probe is None or probe['matched']:
+                return
+
+            rtt = (recv_time - probe['send_time']) * 1000
+            reached = src_ip == self.dest_ip
+            if reached and reply_ttl:
+                self.hop_distance = self._infer_hop_distance(reply_ttl)
+                self.distance_table.record(self.dest_ip, self.hop_distance)
+            if probe['preflight']:
+                probe['matched'] = True
+                self._retire_probe(probe)
+                return
+            if reached:
+                self.reached = True
+            if halt and (self.stop_ttl is None or probe['ttl'] < self.stop_ttl):
+                self.stop_reason, self.stop_ttl = halt, probe['ttl']
+            self.pacer.learn_router(self.dest_ip, probe['ttl'], src_ip)
+            if self.adaptive_wait:
+                self.rtt.sample(rtt / 1000)
+                self.rtt_table.sample(self.dest_ip, rtt / 1000)
+
+            self._record_hop_result(
+                probe['ttl'],
+                probe['series'],
+                probe['proto'],
+                {
+                    'ip': src_ip,
+                    'rtt': rtt,
+                    'reached': reached,
+                    'extensions': extensions
+                }
+            )
+
+            probe['matched'] = True
+            self._retire_probe(probe)
+
+    def _probe_timeout(self) -> float:
+        """RTO from this trace's replies, else from its prefix's; clamped to [--min-wait, --wait]"""
+        if not self.adaptive_wait:
+            return self.timeout
+        rto = self.rtt.timeout()
+        if rto is None:
+            rto = self.rtt_table.timeout(self.dest_ip)
+        if rto is None:
+            return self.timeout
+        return min(max(rto, self.min_timeout), self.timeout)
+
+    def _expire_probes(self, now: float):
+        """Record probes whose deadline has passed as timeouts and drop them. Caller holds self.lock"""
+        deadlines = self.probe_deadlines
+        while deadlines and deadlines[0][0] <= now:
+            _, key = heapq.heappop(deadlines)
+            probe = self.probe_index.pop(key, None)
+            if probe is None:
+                continue  # answered in time
+            if probe['preflight']:
+                self._retire_probe(probe)
+                continue
 
-    def _record_hop_result(self, ttl: int, series: int, proto: str, result: dict):
-        if ttl not in self.results:
-            self.results[ttl] = {
+            self._record_hop_result(
+                probe['ttl'],
+                probe['series'],
+                probe['proto'],
+                {
+                    'ip': None,
+                    'rtt': None,
+                    'reached': False,
+                    'extensions': {}
+                }
+            )
+            self._retire_probe(probe)
+
+    def _retire_probe(self, probe: dict):
+        """Forget an answered or expired probe and wake whoever waits on its hop"""
+        self.probes_sent.pop(probe['id'], None)
+        self.hop_pending[probe['ttl']] -= 1
+        self.reply_cond.notify_all()
+
+    def _record_hop_result(self, ttl: int, series: int, proto: str, result: dict,
+                           results: Optional[dict] = None):
+        results = self.results if results is None else results
+        if ttl not in results:
+            results[ttl] = {
                 'udp': {'probes': [], 'stats': {}},
                 'tcp': {'probes': [], 'stats': {}},
                 'icmp': {'probes': [], 'stats': {}},
@@ -741,7 +2458,7 @@ class Traceroute:
             }
 
         # Record the probe result
-        self.results[ttl][proto]['probes'].append({
+        results[ttl][proto]['probes'].append({
             'rtt': result['rtt'],
             'from': result['ip'],
             'reached': result['reached']
@@ -749,13 +2466,14 @@ class Traceroute:
 
         # Update extensions if present
         if result.get('extensions'):
-            self.results[ttl]['extensions'].update(result['extensions'])
+            results[ttl]['extensions'].update(result['extensions'])
 
         # Update statistics
-        self._update_hop_stats(ttl, proto)
+        self._update_hop_stats(ttl, proto, results)
 
-    def _update_hop_stats(self, ttl: int, proto: str):
-        probes = self.results[ttl][proto]['probes']
+    def _update_hop_stats(self, ttl: int, proto: str, results: Optional[dict] = None):
+        results = self.results if results is None else results
+        probes = results[ttl][proto]['probes']
         valid_rtts = [p['rtt'] for p in probes if p['rtt'] is not None]
 
         stats = {
@@ -771,15 +2489,16 @@ class Traceroute:
                 'avg': sum(valid_rtts) / len(valid_rtts)
             })
 
-        self.results[ttl][proto]['stats'] = stats
+        results[ttl][proto]['stats'] = stats
 
-    def _check_target_reached(self, ttl: int) -> bool:
+    def _check_target_reached(self, ttl: int, results: Optional[dict] = None) -> bool:
         """Check if we've reached the target"""
-        if ttl not in self.results:
+        results = self.results if results is None else results
+        if ttl not in results:
             return False
 
         for proto in ['udp', 'tcp', 'icmp']:
-            for probe in self.results[ttl][proto]['probes']:
+            for probe in results[ttl][proto]['probes']:
                 if probe.get('reached', False):
                     return True
 
@@ -870,8 +2589,18 @@ class Traceroute:
             'protocol': self.protocol,
             'ip_version': self.ip_protocol,
             'timestamp': time.strftime("%Y-%m-%d %H:%M:%S"),
-            'reached_target': self.reached
+            'reached_target': self.reached,
+            'stop_reason': 'reached' if self.reached else self.stop_reason or 'max_hops'
         }
+        if self.hop_distance is not None:
+            self.results['metadata']['hop_distance'] = self.hop_distance
+        if self.lead_protocol:
+            self.results['metadata']['lead_protocol'] = self.lead_protocol
+        if self.stop_set is not None:
+            self.results['metadata']['doubletree'] = {
+                'start_ttl': self.doubletree_start,
+                'backward_stop_ttl': self.backward_stop_ttl
+            }
 
 
 
@@ -879,18 +2608,19 @@ class Traceroute:
     @staticmethod
     def _calculate_checksum(data: bytes) -> int:
         if len(data) % 2 != 0:
-            data += b'\x00'  # Pad to even length
+            data = bytes(data) + b'\x00'  # Pad to even length
 
-        total = 0
-        for i in range(0, len(data), 2):
-            word = (data[i] << 8) + data[i + 1]
-            total += word
-            total = (total & 0xffff) + (total >> 16)
+        # Since 2**16 == 1 (mod 0xFFFF), the ones' complement sum of the 16-bit words is the
+        # buffer read as one big-endian integer, reduced mod 0xFFFF (non-zero data sums to
+        # 0xFFFF rather than 0). int.from_bytes does the word summing in C.
+        total = int.from_bytes(data, 'big')
+        if total:
+            total = total % 0xFFFF or 0xFFFF
 
         return ~total & 0xffff
 
     @staticmethod
-    def _process_icmp_extensions(packet: bytes) -> dict:
+    def _process_icmp_extensions(packet: memoryview) -> dict:
         extensions = {
             'mpls': [],
             'other': []
@@ -902,14 +2632,14 @@ class Traceroute:
         ext_start = 8
 
         while ext_start + 4 <= len(packet):
-            ext_type, ext_len = struct.unpack("!BB", packet[ext_start:ext_start + 2])
+            ext_type, ext_len = packet[ext_start], packet[ext_start + 1]
 
             # MPLS extension (type 1)
             if ext_type == 1 and ext_len >= 8:
                 mpls_data = packet[ext_start + 4:ext_start + ext_len]
                 for i in range(0, len(mpls_data), 4):
                     if i + 4 <= len(mpls_data):
-                        label = struct.unpack("!I", mpls_data[i:i + 4])[0]
+                        label = _U32.unpack_from(mpls_data, i)[0]
                         extensions['mpls'].append({
                             'label': label >> 12,
                             'tc': (label >> 9) & 0x7,
@@ -922,32 +2652,537 @@ class Traceroute:
                 extensions['other'].append({
                     'type': ext_type,
                     'length': ext_len,
-                    'data': packet[ext_start + 4:ext_start + ext_len]
+                    'data': bytes(packet[ext_start + 4:ext_start + ext_len])
                 })
 
+            # A zero length would never advance past this object
+            if ext_len == 0:
+                break
             ext_start += ext_len
 
         return extensions
 
     def close(self):
-        self.recv_running = False
+        self._stop_receiver()
+
+        if self.session_socks:
+            # Session sockets outlive the trace
+            self.session.release(self)
+            self.session_socks = False
+            self.socks = {}
+        for sock in list(self.socks.values()) + [self.sock]:
+            if sock:
+                try:
+                    sock.close()
+                except:
+                    pass
+        self.socks = {}
+        self.sock = None
+
 
-        if hasattr(self, 'sock') and self.sock:
+class TraceSession:
+    """
+    Long-lived send sockets, route source addresses and receiver for many traces run
+    with the same options, so a batch pays the socket setup once instead of per target.
+    Traces to a destination that is already being traced fall back to their own sockets,
+    since replies are told apart by (destination, source port) on the shared receiver.
+    """
+
+    def __init__(self, options: TraceOptions):
+        self.options = options
+        self.lock = Lock()
+        self.src_port = options.sport or random.randint(32768, 61000)
+        self.groups = {}          # (ip version, source IP) -> {'socks', 'src_port', 'send_lock'}
+        self.sources = {}         # destination IP -> source address the kernel routes from
+        self.active = set()       # destination IPs with a trace holding session sockets
+        self.demuxes = {}         # ip version -> receiver held for the session's lifetime
+
+    def trace(self, host: str, stop_set: Optional['StopSet'] = None) -> dict:
+        tracer = Traceroute(self.options.with_target(host), session=self)
+        tracer.stop_set = stop_set
+        return tracer.run()
+
+    def source_for(self, dest_ip: str, ip_protocol: str) -> str:
+        """Source address of the route to dest_ip, looked up once per destination"""
+        with self.lock:
+            src_ip = self.sources.get(dest_ip)
+            if src_ip is None:
+                src_ip = _route_source(dest_ip, ip_protocol)
+                if not src_ip:
+                    return ''
+                self.sources[dest_ip] = src_ip
+            return src_ip
+
+    def lease(self, tracer: 'Traceroute') -> bool:
+        """Hand the session's sockets for tracer's route to tracer; False if it must open its own"""
+        if tracer.unprivileged:
+            # Errors are queued per socket there, so every trace keeps its own sockets
+            return False
+        with self.lock:
+            if tracer.dest_ip in self.active:
+                return False
+            if tracer.ip_protocol not in self.demuxes:
+                # Keep the shared receiver up between traces
+                demux = self.demuxes[tracer.ip_protocol] = ReplyDemux.get(tracer.ip_protocol)
+                demux.acquire()
+
+            group = self.groups.setdefault((tracer.ip_protocol, tracer.src_ip),
+                                           {'socks': {}, 'src_port': self.src_port, 'send_lock': Lock()})
+            tracer.src_port = group['src_port']
+            for proto in tracer._probe_protocols():
+                if proto not in group['socks']:
+                    sock = tracer._create_send_socket(proto)
+                    tracer._config_socket_options(sock)
+                    group['socks'][proto] = sock
+                    group['src_port'] = tracer.src_port
+
+            self.active.add(tracer.dest_ip)
+            tracer.socks = dict(group['socks'])
+            tracer.send_lock = group['send_lock']
+        return True
+
+    def release(self, tracer: 'Traceroute'):
+        with self.lock:
+            self.active.discard(tracer.dest_ip)
+
+    def close(self):
+        if self.options.protocol_table:
+            ProtocolPreferenceTable.get(self.options.protocol_table).save()
+        with self.lock:
+            for group in self.groups.values():
+                for sock in group['socks'].values():
+                    sock.close()
+            for demux in self.demuxes.values():
+                demux.release()
+            self.groups, self.demuxes = {}, {}
+
+    def __enter__(self) -> 'TraceSession':
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+
+class AsyncTraceroute(Traceroute):
+    """
+    Traceroute for asyncio programs. Replies come from a loop reader on the shared raw
+    socket, hop deadlines are loop timers and pacing uses asyncio.sleep, so thousands
+    of traces can share one event loop without a thread per target.
+    """
+
+    async def run_async(self) -> dict:
+        self.loop = asyncio.get_running_loop()
+        self.progress = asyncio.Event()
+
+        # Resolve on the loop so that the synchronous init only sees an address
+        try:
+            addrinfo = await self.loop.getaddrinfo(self.options.host, None, family=socket.AF_INET)
+        except socket.gaierror as e:
+            raise ValueError(f"Unable to resolve host {self.options.host}: {e}")
+        self.options = replace(self.options, host=addrinfo[0][4][0])
+        self.init()
+
+        try:
+            self._start_receiver()
+            self._init_probe_templates()
+            for sock in self.socks.values():
+                sock.setblocking(False)
+            self._apply_hop_distance()
+            if self.preflight:
+                delay = self._reserve_send(PREFLIGHT_TTL) - time.monotonic()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                if self._send_preflight(paced=False):
+                    await self._wait_for_hop_async(PREFLIGHT_TTL)
+                    self._apply_hop_distance()
+            await self._run_window_async()
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            self._print_warning(f"Traceroute failed: {e}")
+        finally:
+            self.close()
+            with self.lock:
+                self._expire_probes(float('inf'))
+            self._trim_beyond_target()
+            self._sort_hops()
+            self._record_protocol_answers()
+            self._display_final_results()
+        return self.results
+
+    def _get_demux(self) -> ReplyDemux:
+        return AsyncReplyDemux.get_for_loop(self.ip_protocol, self.loop)
+
+    def _start_socket_reader(self):
+        for proto, sock in self.socks.items():
+            self.loop.add_reader(sock.fileno(), self._read_socket_replies, sock, proto)
+
+    def _stop_socket_reader(self):
+        for sock in self.socks.values():
+            self.loop.remove_reader(sock.fileno())
+
+    async def _run_window_async(self):
+        for ttls, forward in self._probe_phases():
+            await self._run_ttls_async(ttls, forward)
+
+    async def _run_ttls_async(self, ttls: range, forward: bool):
+        """Same hop scheduling as _run_ttls, awaiting instead of blocking"""
+        ttls = iter(ttls)
+        next_ttl = next(ttls, None)
+        in_flight = deque()
+
+        while True:
+            while len(in_flight) < self.window and next_ttl is not None and not self._phase_done(forward):
+                await self._probe_hop_async(next_ttl)
+                in_flight.append(next_ttl)
+                next_ttl = next(ttls, None)
+
+            if not in_flight:
+                break
+
+            ttl = in_flight.popleft()
+            await self._wait_for_hop_async(ttl)
+            retries = self._hop_retries(ttl)
+            while retries:
+                await self._send_paced_async(ttl, retries)
+                await self._wait_for_hop_async(ttl)
+                retries = self._hop_retries(ttl)
+            if self._retire_hop(ttl, forward):
+                break
+
+    async def _probe_hop_async(self, ttl: int):
+        for series in range(self.series_count):
+            await self._send_paced_async(ttl, self._series_probes(series))
+
+            if series + 1 < self.series_count:
+                self._delay_next_send(self.series_interval)
+
+    async def _send_paced_async(self, ttl: int, probes: list):
+        for deadline, batch in self._due_batches(ttl, probes):
+            delay = deadline - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            self._send_probe_batch(ttl, batch)
+
+    async def _wait_for_hop_async(self, ttl: int):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self._expire_probes(now)
+                if self.hop_pending.get(ttl, 0) <= 0:
+                    return
+                remaining = self.hop_deadline[ttl] - now
+                self.progress.clear()
+
+            # Woken by a reply for this trace or by the hop deadline timer
+            timer = self.loop.call_later(max(remaining, 0), self.progress.set)
             try:
-                self.sock.close()
-            except:
-                pass
+                await self.progress.wait()
+            finally:
+                timer.cancel()
+
+    def _retire_probe(self, probe: dict):
+        super()._retire_probe(probe)
+        self.progress.set()
+
+
+async def trace_async(host: str, options: Union[dict, TraceOptions, None] = None) -> dict:
+    """Trace host on the running event loop; a dict uses the TraceOptions field names"""
+    if not isinstance(options, TraceOptions):
+        options = TraceOptions.from_dict(options or {}).validate()
+    return await AsyncTraceroute(options.with_target(host)).run_async()
+
+
+class RandomPermutation:
+    """
+    Pseudo-random permutation of range(size) in constant memory: a keyed Feistel network
+    over the next even power of two, cycle-walking values that fall outside the range.
+    """
+    ROUNDS = 4
+
+    def __init__(self, size: int, seed: Optional[int] = None):
+        self.size = size
+        bits = max(2, (size - 1).bit_length())
+        self.half_bits = (bits + 1) // 2
+        self.half_mask = (1 << self.half_bits) - 1
+        rng = random.Random(seed)
+        self.keys = [rng.getrandbits(32) for _ in range(self.ROUNDS)]
+
+    def _round(self, value: int, key: int) -> int:
+        value = ((value ^ key) * 0x9E3779B1) & 0xFFFFFFFF
+        value ^= value >> 15
+        return (value * 0x85EBCA6B) & self.half_mask
+
+    def _encrypt(self, value: int) -> int:
+        left, right = value >> self.half_bits, value & self.half_mask
+        for key in self.keys:
+            left, right = right, left ^ self._round(right, key)
+        return (left << self.half_bits) | right
+
+    def __getitem__(self, index: int) -> int:
+        value = self._encrypt(index)
+        while value >= self.size:
+            value = self._encrypt(value)
+        return value
+
+    def __iter__(self):
+        for index in range(self.size):
+            yield self[index]
+
+    def __len__(self):
+        return self.size
+
+
+class YarrpTraceroute(Traceroute):
+    """
+    Stateless traceroute over a target list. The probe TTL and a send timestamp travel
+    in the probe headers and a checksum of the target sits in the source port / ICMP
+    identifier, so the sender keeps no per-probe state. (target, TTL) pairs are sent in
+    a pseudo-random order at a steady rate, spreading the load over many routers.
+
+    Header encoding (IPv4):
+      udp:  sport = target check, dport = port + TTL, IP ID = send stamp
+      tcp:  sport = target check, seq = TTL << 24 | send time (ms, 24 bits)
+      icmp: ident = target check, seq = TTL, IP ID and first payload word = send stamp
+    The send stamp is 0x8000 | send time (ms, 15 bits), never zero so the kernel keeps it.
+    """
+
+    def init(self):
+        self._init_basic_parameters()
+        self._init_output_parameters()
 
-        if hasattr(self, 'recv_sock') and self.recv_sock:
+        self.ip_protocol = '4'
+        self.protocol = self.options.protocol.lower()
+        self.type_of_service = self.options.tos
+        self.flag_df = self.options.dont_fragment
+        self.dest_port = self.options.port or 33434
+        self.packet_size = self.options.packet_size
+        self.pps = self.options.pps
+
+        # The source address is part of every probe, so targets behind different routes
+        # get their own template; a template is built once per source address
+        self.targets = []
+        self.target_templates = []
+        templates = {}
+        for host in dict.fromkeys(self._get_target_list()):
             try:
-                self.recv_sock.close()
-            except:
-                pass
+                target = socket.getaddrinfo(host, None, socket.AF_INET)[0][4][0]
+            except socket.gaierror as e:
+                self._print_warning(f"Failed to resolve {host}: {e}")
+                continue
+            src_ip = self.options.source or _route_source(target, self.ip_protocol)
+            if not src_ip:
+                self._print_warning(f"No route to {host}, skipping it")
+                continue
+            if src_ip not in templates:
+                templates[src_ip] = self._build_stateless_template(socket.inet_aton(src_ip))
+            self.targets.append(target)
+            self.target_templates.append(templates[src_ip])
+        if not self.targets:
+            raise ValueError("No valid targets for stateless mode")
+
+        self.dest_ip = self.targets[0]
+        self.target_results = {}
+
+        try:
+            # IPPROTO_RAW implies IP_HDRINCL: TTL and IP ID are written by us
+            self.sock = socket.socket(socket.AF_INET, socket.SOCK_RAW, socket.IPPROTO_RAW)
+        except PermissionError as e:
+            self._print_warning(f"Permission denied: {e}. Try running as root.")
+            sys.exit(1)
+
+    def run(self) -> dict:
+        self.init()
+        self.start_time = time.monotonic()
+
+        try:
+            self.demux = ReplyDemux.get(self.ip_protocol)
+            self.demux.acquire()
+            self.recv_running = True
+            self.demux.add_sink(self._on_stateless_reply)
+
+            try:
+                self._send_permuted_probes()
+                # Give the last probes their full wait before stopping
+                time.sleep(self.timeout)
+            except KeyboardInterrupt:
+                print("\nTrace interrupted by user")
+
+        except Exception as e:
+            self._print_warning(f"Traceroute failed: {e}")
+        finally:
+            self.close()
+            self._finish_target_results()
+            return self.target_results
+
+    def _stop_receiver(self):
+        if self.demux:
+            self.demux.remove_sink(self._on_stateless_reply)
+        super()._stop_receiver()
+
+    def _send_permuted_probes(self):
+        hop_count = self.max_hops
+        target_addrs = [socket.inet_aton(t) for t in self.targets]
+        interval = 1.0 / self.pps
+        next_send = time.monotonic()
+
+        batch, first = [], 0.0
+        for pair in RandomPermutation(len(self.targets) * hop_count):
+            target_index, hop_index = divmod(pair, hop_count)
+            # Behind schedule: send back to back, but forget a backlog older than PACER_MAX_LAG
+            next_send = max(next_send, time.monotonic() - PACER_MAX_LAG)
+            if batch and (next_send > max(first, time.monotonic()) or len(batch) >= SEND_BATCH_MAX):
+                self._send_stateless_batch(batch)
+                batch = []
+            if not batch:
+                _sleep_until(next_send)
+                first = next_send
+            next_send += interval
+
+            # The template is patched in place, so each batched probe is a copy
+            elapsed_ms = int((time.monotonic() - self.start_time) * 1000)
+            packet = self._build_stateless_probe(self.target_templates[target_index],
+                                                 target_addrs[target_index],
+                                                 self.first_ttl + hop_index, elapsed_ms)
+            batch.append((bytes(packet), (self.targets[target_index], 0), None))
+        self._send_stateless_batch(batch)
+
+    def _send_stateless_batch(self, batch: list):
+        """Send (packet, address, None) probes with one sendmmsg call where available"""
+        sent = 0
+        if _libc_sendmmsg is not None and len(batch) > 1:
+            sent = self._sendmmsg(self.sock, batch)
+        for packet, address, _ in batch[sent:]:
+            try:
+                self.sock.sendto(packet, address)
+            except OSError as e:
+                if self.flag_verbose:
+                    self._print_warning(f"Failed to send probe to {address[0]}: {e}")
+
+    @staticmethod
+    def _target_check(addr: bytes) -> int:
+        total = ((addr[0] << 8) | addr[1]) + ((addr[2] << 8) | addr[3])
+        return ((total & 0xFFFF) + (total >> 16)) or 1
+
+    def _build_stateless_template(self, src_addr: bytes) -> bytearray:
+        """IPv4 probe with zeroed per-probe fields; checksums stay valid while fields are patched"""
+        if self.protocol == 'udp':
+            payload = b"P" * self.packet_size
+            # A zero UDP checksum means "no checksum" over IPv4
+            transport = struct.pack("!HHHH", 0, 0, 8 + len(payload), 0) + payload
+            ip_proto = socket.IPPROTO_UDP
+        elif self.protocol == 'tcp':
+            header = struct.pack("!HHLLBBHHH", 0, self.dest_port, 0, 0, 5 << 4, 0x02, 8192, 0, 0)
+            pseudo_header = struct.pack("!4s4sBBH", src_addr, bytes(4), 0, socket.IPPROTO_TCP, len(header))
+            checksum = self._calculate_checksum(pseudo_header + header)
+            transport = header[:16] + struct.pack("!H", checksum) + header[18:]
+            ip_proto = socket.IPPROTO_TCP
+        else:
+            payload = bytes(2) + b"P" * max(0, self.packet_size - 10)
+            checksum = self._calculate_checksum(struct.pack("!BBHHH", 8, 0, 0, 0, 0) + payload)
+            transport = struct.pack("!BBHHH", 8, 0, checksum, 0, 0) + payload
+            ip_proto = socket.IPPROTO_ICMP
+
+        ip_header = struct.pack("!BBHHHBBH4s4s",
+                                0x45, self.type_of_service, 20 + len(transport),
+                                0, 0x4000 if self.flag_df else 0,
+                                0, ip_proto, 0,
+                                src_addr, bytes(4))
+        checksum = self._calculate_checksum(ip_header)
+        return bytearray(ip_header[:10] + struct.pack("!H", checksum) + ip_header[12:] + transport)
+
+    def _build_stateless_probe(self, packet: bytearray, dst_addr: bytes, ttl: int, elapsed_ms: int) -> bytearray:
+        """Patch the target's route template in place for one (target, TTL) probe"""
+        ident = self._target_check(dst_addr)
+        stamp = 0x8000 | (elapsed_ms & 0x7FFF)
+        patch = self._patch_u16
+
+        if self.protocol == 'tcp':
+            # The destination is part of the TCP pseudo header
+            patch(packet, 16, (dst_addr[0] << 8) | dst_addr[1], 10, 36)
+            patch(packet, 18, (dst_addr[2] << 8) | dst_addr[3], 10, 36)
+            patch(packet, 20, ident, 36)
+            self._patch_u32(packet, 24, (ttl << 24) | (elapsed_ms & 0xFFFFFF), 36)
+        else:
+            patch(packet, 16, (dst_addr[0] << 8) | dst_addr[1], 10)
+            patch(packet, 18, (dst_addr[2] << 8) | dst_addr[3], 10)
+            if self.protocol == 'udp':
+                patch(packet, 20, ident)
+                patch(packet, 22, self.dest_port + ttl)
+            else:
+                patch(packet, 24, ident, 22)
+                patch(packet, 26, ttl, 22)
+                patch(packet, 28, stamp, 22)
+
+        patch(packet, 4, stamp, 10)
+        patch(packet, 8, (ttl << 8) | packet[9], 10)
+        return packet
+
+    def _on_stateless_reply(self, reply: ParsedReply):
+        """Decode TTL and RTT from the quoted probe; replies failing the target check are dropped"""
+        try:
+            if reply.proto != self.protocol:
+                return
+            if reply.identifier != self._target_check(socket.inet_aton(reply.dest_ip)):
+                return
+
+            now_ms = int((reply.recv_time - self.start_time) * 1000)
+            transport = reply.transport
+            if reply.proto == 'udp':
+                ttl = reply.seq - self.dest_port
+                sent_ms = struct.unpack_from("!H", transport, 12)[0]  # quoted IP ID
+                rtt = (now_ms - sent_ms) & 0x7FFF
+            elif reply.proto == 'tcp':
+                ttl = reply.seq >> 24
+                rtt = (now_ms - reply.seq) & 0xFFFFFF
+            else:
+                ttl = reply.seq
+                # Echo replies carry our payload back, errors quote our IP header
+                sent_ms = struct.unpack_from("!H", transport, 8 if reply.icmp_type == 0 else 12)[0]
+                rtt = (now_ms - sent_ms) & 0x7FFF
+
+            if not self.first_ttl <= ttl < self.first_ttl + self.max_hops:
+                return
+
+            extensions = {}
+            if self.flag_show_extensions and reply.icmp_type is not None:
+                extensions.update(self._process_icmp_extensions(transport))
+
+            with self.lock:
+                results = self.target_results.setdefault(reply.dest_ip, {})
+                self._record_hop_result(ttl, 0, reply.proto, {
+                    'ip': reply.src_ip,
+                    'rtt': float(rtt),
+                    'reached': reply.src_ip == reply.dest_ip,
+                    'extensions': extensions
+                }, results)
+        except Exception as e:
+            if self.flag_verbose:
+                self._print_warning(f"Error processing reply: {e}")
+
+    def _finish_target_results(self):
+        timestamp = time.strftime("%Y-%m-%d %H:%M:%S")
+        for target in self.targets:
+            results = self.target_results.get(target, {})
+            self._trim_beyond_target(results)
+            # Replies arrive in permutation order; store hops in TTL order
+            results = self.target_results[target] = {ttl: results[ttl] for ttl in sorted(results)}
+            results['metadata'] = {
+                'series': [self.protocol],
+                'target': target,
+                'protocol': self.protocol,
+                'ip_version': self.ip_protocol,
+                'timestamp': timestamp,
+                'reached_target': any(self._check_target_reached(ttl, results)
+                                      for ttl in results if isinstance(ttl, int))
+            }
 
 
 if __name__ == "__main__":
     try:
         traceroute = Traceroute()
+        if traceroute.options.stateless:
+            traceroute = YarrpTraceroute(traceroute.options)
         traceroute.run()
 
     except KeyboardInterrupt:
@@ -0,0 +1,55 @@
+"""
+Microbenchmark for Traceroute._calculate_checksum.
+
+Compares the bulk implementation against the original per-word Python loop on
+random packets from 28 to 1500 bytes, checking both give identical results.
+
+    python bench_checksum.py [--rounds N]
+"""
+import argparse
+import os
+import timeit
+
+from My_traceroute_fixed import Traceroute
+
+SIZES = [28, 40, 64, 128, 256, 512, 1024, 1500]
+
+
+def reference_checksum(data: bytes) -> int:
+    """The original word-at-a-time loop"""
+    if len(data) % 2 != 0:
+        data += b'\x00'
+
+    total = 0
+    for i in range(0, len(data), 2):
+        word = (data[i] << 8) + data[i + 1]
+        total += word
+        total = (total & 0xffff) + (total >> 16)
+
+    return ~total & 0xffff
+
+
+def check_identical(samples: int = 2000):
+    edge_cases = [b'', b'\x01', b'\x00' * 20, b'\xff\xff', b'\xff' * 40, b'\x00\x01\xff\xfe']
+    for data in edge_cases + [os.urandom(n) for n in range(1, samples)]:
+        expected = reference_checksum(data)
+        assert Traceroute._calculate_checksum(data) == expected, data
+        assert Traceroute._calculate_checksum(bytearray(data)) == expected, data
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Internet checksum microbenchmark")
+    parser.add_argument("--rounds", type=int, default=20000, help="Checksum calls per packet size")
+    args = parser.parse_args()
+
+    check_identical()
+    print(f"{'bytes':>6}  {'loop (us)':>10}  {'bulk (us)':>10}  {'speedup':>8}")
+    for size in SIZES:
+        data = os.urandom(size)
+        loop = timeit.timeit(lambda: reference_checksum(data), number=args.rounds) / args.rounds
+        bulk = timeit.timeit(lambda: Traceroute._calculate_checksum(data), number=args.rounds) / args.rounds
+        print(f"{size:>6}  {loop * 1e6:>10.2f}  {bulk * 1e6:>10.2f}  {loop / bulk:>7.1f}x")
+
+
+if __name__ == "__main__":
+    main()
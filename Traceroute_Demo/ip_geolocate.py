@@ -50,8 +50,8 @@ def process_traceroute_json(json_file_path: str, csv_writer) -> None:
             # for protocol in ["udp", "tcp", "icmp"]:
             protocol = "udp" if "udp" in hop_data else "tcp" if "tcp" in hop_data else "icmp"
             if "probes" in hop_data[protocol]:
-                probe = hop_data[protocol]["probes"][0]
-                ip_address = probe.get("from")
+                # 超时的探测没有来源IP，取第一个有应答的探测
+                ip_address = next((p.get("from") for p in hop_data[protocol]["probes"] if p.get("from")), None)
                 if ip_address:
                     if not all_ips:
                         all_ips.append(ip_address)
@@ -0,0 +1,54 @@
+import errno
+import unittest
+
+from My_traceroute_fixed import Traceroute, TraceOptions
+
+
+class FailingSocket:
+    """Send socket whose every call fails, as with an oversized probe"""
+
+    def setsockopt(self, *args):
+        raise OSError(errno.EMSGSIZE, "Message too long")
+
+    def sendto(self, *args):
+        raise OSError(errno.EMSGSIZE, "Message too long")
+
+    def close(self):
+        pass
+
+
+class HopRetryTest(unittest.TestCase):
+    def _tracer(self, **options) -> Traceroute:
+        tracer = Traceroute(TraceOptions(host='127.0.0.1', wait=50, max_hops=2, no_resolve=True, **options))
+        tracer._init_basic_parameters()
+        tracer._init_output_parameters()
+        tracer.dest_ip, tracer.ip_protocol = '127.0.0.1', '4'
+        tracer.src_port, tracer.icmp_ident = 33000, 1
+        tracer.lead_protocol = None
+        tracer.socks = {proto: FailingSocket() for proto in tracer.probe_sequence}
+        return tracer
+
+    def _retry_rounds(self, tracer: Traceroute, ttl: int = 1, limit: int = 10) -> int:
+        """Drive one hop the way _run_ttls does; the number of retry rounds it took"""
+        tracer._probe_hop(ttl)
+        for rounds in range(limit):
+            retries = tracer._hop_retries(ttl)
+            if not retries:
+                return rounds
+            tracer._send_paced(ttl, retries)
+        self.fail(f"hop {ttl} still asks for retries after {limit} rounds")
+
+    def test_failed_fallback_protocol_counts_as_attempted(self):
+        tracer = self._tracer(probe_sequence=['udp', 'icmp'], queries=1)
+        tracer.lead_protocol = 'udp'
+        self.assertEqual(self._retry_rounds(tracer), 1)
+        self.assertEqual(tracer.hop_sent[(1, 'icmp')], 1)
+
+    def test_failed_sends_use_up_adaptive_queries(self):
+        tracer = self._tracer(probe_sequence=['udp'], queries=3, adaptive_queries=True)
+        self.assertEqual(self._retry_rounds(tracer), 2)
+        self.assertEqual(tracer.hop_sent[(1, 'udp')], 3)
+
+
+if __name__ == "__main__":
+    unittest.main()